@@ -1,41 +1,424 @@
 """
 Class for arranginge padded batches.
 """
-import copy
-from random import shuffle
+import queue
+import random
+import threading
+import time
+from bisect import bisect_left
+from itertools import chain
+
+import numpy as np
+
+try:
+    from .logger import timed_stage
+except ImportError:  # imported as a top-level module, as in check.py
+    from logger import timed_stage
 
 class Batches(object):
-    def __init__(self, batch_size, pad_sym=0):
+    def __init__(self, batch_size, pad_sym=0, bucket_boundaries=None, bucket_window=None, max_tokens=None,
+                 seed=None, rank=0, world_size=1, timer=None):
+        assert batch_size is not None or max_tokens is not None, "Give a batch_size, a max_tokens or both"
         self.batch_size = batch_size
         self.pad_sym = pad_sym
 
+        # Length bucketing, used by gen_bucketed_batches(), without a batch_size the whole epoch is sorted
+        self.bucket_boundaries = sorted(bucket_boundaries) if bucket_boundaries else None
+        self.bucket_window = bucket_window or (100 * batch_size if batch_size else None)
+
+        # Padded token budget (batch_len * max_len) per batch of the *_epochs() and bucketed/budget
+        # generators, batch_size (if given) then only caps batch_len
+        self.max_tokens = max_tokens
+
+        # Seeded epoch order, sharding over data-parallel workers and resume position
+        self.sampler = BatchSampler(seed, rank, world_size)
+
+        self.padding_efficiency = []  # real tokens / padded tokens of each epoch
+        self.timer = timer  # StageTimer recording the time spent assembling each batch, or None
+
     def pad_batch(self, batch):
         max_len = max([len(b_seq) for b_seq in batch])
         lengths = []
 
+        padded = []
         for idx, batched_seq in enumerate(batch):
             current_len = len(batched_seq)
             lengths.append(current_len)
-            if current_len < max_len:
-                padding = [self.pad_sym for _ in range(max_len - current_len)]
-                batched_seq.extend(padding)
-        return batch, lengths
+            padding = [self.pad_sym for _ in range(max_len - current_len)]
+            padded.append(list(batched_seq) + padding)
+        return padded, lengths
 
     def gen_padded_batches(self, data):
+        assert self.max_tokens is None, "gen_padded_batches() has no token budget, use gen_budget_batches()"
         X, Y = zip(*data)
         data_len = len(X)
         n_steps = data_len // self.batch_size
 
         for step in range(n_steps):
-            idx_start = self.batch_size * step
-            idx_end   = self.batch_size * (step+1)
-            batch_x = X[ idx_start : idx_end ]
-            batch_y = Y[ idx_start : idx_end ]
-            padded_x, lengths = self.pad_batch(batch_x)
+            with timed_stage(self.timer, 'batch_assembly') as stage:
+                idx_start = self.batch_size * step
+                idx_end   = self.batch_size * (step+1)
+                batch_x = X[ idx_start : idx_end ]
+                batch_y = Y[ idx_start : idx_end ]
+                padded_x, lengths = self.pad_batch(batch_x)
+                stage.items = len(lengths)
             yield (padded_x, batch_y, lengths)
 
     def gen_padded_batch_epochs(self, data, num_epochs):
-        for i in range(num_epochs):
-            shuffled_data = copy.deepcopy(data)
-            shuffle(shuffled_data)
-            yield self.gen_padded_batches(shuffled_data)
+        """
+        Yield a generator of shuffled padded batches for each epoch, the last partial batch is dropped.
+        data is a list of (token_ids, label) examples or a TokenCorpus.
+        With max_tokens, batches are instead packed up to the budget as in gen_budget_batches().
+        The num_epochs epochs continue from the sampler position, see BatchSampler: after
+        load_state_dict() the first one finishes the interrupted epoch.
+        """
+        return self._gen_epochs(data, num_epochs, 'padded')
+
+    def gen_bucketed_batches(self, data):
+        """
+        Yield padded batches of examples with similar lengths for the next epoch, in shuffled batch order.
+        Unlike gen_padded_batches(), the last partial batch of each bucket is kept.
+        """
+        return next(self._gen_epochs(data, 1, 'bucketed'))
+
+    def gen_bucketed_batch_epochs(self, data, num_epochs):
+        return self._gen_epochs(data, num_epochs, 'bucketed')
+
+    def gen_budget_batches(self, data):
+        """
+        Yield padded batches for the next epoch, packed greedily in shuffled order up to max_tokens
+        padded tokens each. Use gen_bucketed_batches() to pack after length sorting instead.
+        Every example is used once, an example longer than max_tokens gets a batch on its own.
+        """
+        return next(self._gen_epochs(data, 1, 'budget'))
+
+    def gen_budget_batch_epochs(self, data, num_epochs):
+        return self._gen_epochs(data, num_epochs, 'budget')
+
+    def gen_array_batches(self, corpus, order=None):
+        """
+        Yield (padded_x, batch_y, lengths) NumPy batches from a TokenCorpus, taking examples in order.
+        As in gen_padded_batches(), the last partial batch is dropped.
+        """
+        assert self.max_tokens is None, "gen_array_batches() has no token budget, use gen_array_batch_epochs()"
+        if order is None:
+            order = np.arange(len(corpus))
+        n_steps = len(order) // self.batch_size
+
+        for step in range(n_steps):
+            with timed_stage(self.timer, 'batch_assembly') as stage:
+                batch_idx = order[ self.batch_size * step : self.batch_size * (step+1) ]
+                padded_x, lengths, batch_y = corpus.gather(batch_idx, self.pad_sym)
+                stage.items, stage.n_bytes = len(lengths), padded_x.nbytes
+            yield (padded_x, batch_y, lengths)
+
+    def gen_array_batch_epochs(self, corpus, num_epochs):
+        """
+        Only an index permutation is shuffled each epoch, the corpus itself is never copied.
+        Batches are cut as in gen_padded_batch_epochs().
+        """
+        return self._gen_epochs(corpus, num_epochs, 'padded')
+
+    def state_dict(self):
+        return self.sampler.state_dict()
+
+    def load_state_dict(self, state):
+        self.sampler.load_state_dict(state)
+
+    def _gen_epochs(self, data, num_epochs, mode):
+        lengths = self._lengths(data)
+        start = self.sampler.epoch
+        for epoch in range(start, start + num_epochs):
+            make_batches = lambda rng: self._epoch_batches(lengths, mode, rng)
+            yield self._gen_index_batches(data, self.sampler.sample_epoch(epoch, make_batches))
+
+    def _gen_index_batches(self, data, batches):
+        """
+        Yield padded batches for lists of example indexes, from a list of examples or a TokenCorpus.
+        Padding efficiency of the epoch is appended to self.padding_efficiency.
+        """
+        n_real, n_padded = 0, 0
+        for batch_idx in batches:
+            with timed_stage(self.timer, 'batch_assembly') as stage:
+                if isinstance(data, TokenCorpus):
+                    padded_x, batch_lengths, batch_y = data.gather(batch_idx, self.pad_sym)
+                    n_real += int(batch_lengths.sum())
+                    stage.n_bytes = padded_x.nbytes
+                else:
+                    batch_x = [data[idx][0] for idx in batch_idx]
+                    batch_y = [data[idx][1] for idx in batch_idx]
+                    padded_x, batch_lengths = self.pad_batch(batch_x)
+                    n_real += sum(batch_lengths)
+                stage.items = len(batch_lengths)
+            n_padded += len(batch_lengths) * int(max(batch_lengths))
+            yield (padded_x, batch_y, batch_lengths)
+
+        self.padding_efficiency.append(n_real / n_padded if n_padded else 1.0)
+
+    def _lengths(self, data):
+        if isinstance(data, TokenCorpus):
+            return data.lengths.tolist()
+        return [len(x) for x, _ in data]
+
+    def _epoch_batches(self, lengths, mode, rng):
+        """All index batches of one epoch, drawing randomness from the numpy Generator rng."""
+        order = rng.permutation(len(lengths)).tolist()
+        if mode == 'padded' and self.max_tokens is None:
+            n_steps = len(order) // self.batch_size
+            return [order[ self.batch_size * step : self.batch_size * (step+1) ] for step in range(n_steps)]
+        if mode == 'bucketed':
+            batches = self._bucket_batches(order, lengths)
+            rng.shuffle(batches)
+            return batches
+        return self._cut_batches(order, lengths)
+
+    def _bucket_batches(self, order, lengths):
+        """
+        Group shuffled example indexes by length and cut the groups into batches.
+        With bucket_boundaries, bucket i holds lengths in (boundaries[i-1], boundaries[i]],
+        otherwise indexes are sorted by length within windows of bucket_window examples.
+        """
+        if self.bucket_boundaries:
+            groups = [[] for _ in range(len(self.bucket_boundaries) + 1)]
+            for idx in order:
+                groups[bisect_left(self.bucket_boundaries, lengths[idx])].append(idx)
+        else:
+            window = self.bucket_window or max(len(order), 1)
+            groups = [sorted(order[start : start+window], key=lengths.__getitem__)
+                      for start in range(0, len(order), window)]
+
+        batches = []
+        for group in groups:
+            batches.extend(self._cut_batches(group, lengths))
+        return batches
+
+    def _cut_batches(self, indexes, lengths):
+        """
+        Cut a list of example indexes into consecutive batches, keeping the last partial batch.
+        Batches hold batch_size examples, or with max_tokens are packed greedily while
+        batch_len * max_len stays within max_tokens (and batch_len within batch_size).
+        """
+        if self.max_tokens is None:
+            return [indexes[start : start+self.batch_size] for start in range(0, len(indexes), self.batch_size)]
+
+        batches = []
+        batch, batch_max = [], 0
+        for idx in indexes:
+            new_max = max(batch_max, lengths[idx])
+            if batch and ((len(batch)+1) * new_max > self.max_tokens or len(batch) == self.batch_size):
+                batches.append(batch)
+                batch, new_max = [], lengths[idx]
+            batch.append(idx)
+            batch_max = new_max
+        if batch:
+            batches.append(batch)
+        return batches
+
+
+class BatchSampler(object):
+    """
+    Seeded, sharded and resumable order of index batches.
+    Epoch e is drawn from a numpy Generator seeded with (seed, e), so every worker computes the same
+    epoch and keeps the disjoint shard batches[rank::world_size]. All ranks get the same number of
+    batches, the last len(batches) % world_size batches of an epoch are dropped when sharding.
+    epoch and step (batches of the epoch already yielded on this rank) can be saved with
+    state_dict() and restored with load_state_dict() to resume an interrupted run. When batches
+    are prefetched, step runs ahead of the training loop by the number of queued batches.
+    """
+    def __init__(self, seed=None, rank=0, world_size=1):
+        assert 0 <= rank < world_size, "rank should be in [0, world_size). Rank: {}".format(rank)
+        if seed is None:
+            seed = random.randrange(2**32)
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+
+        self.epoch = 0
+        self.step = 0
+
+    def shard(self, batches):
+        n_per_rank = len(batches) // self.world_size
+        return batches[ self.rank : n_per_rank * self.world_size : self.world_size ]
+
+    def sample_epoch(self, epoch, make_batches):
+        """
+        Yield the index batches of this rank for an epoch, make_batches(rng) builds all batches.
+        Resuming the current epoch skips the batches already yielded.
+        """
+        batches = self.shard(make_batches(np.random.default_rng([self.seed, epoch])))
+        start = self.step if epoch == self.epoch else 0
+        self.epoch, self.step = epoch, start
+        for batch in batches[start:]:
+            self.step += 1
+            yield batch
+        self.epoch, self.step = epoch + 1, 0
+
+    def state_dict(self):
+        return {'seed': self.seed, 'epoch': self.epoch, 'step': self.step,
+                'rank': self.rank, 'world_size': self.world_size}
+
+    def load_state_dict(self, state):
+        assert state['world_size'] == self.world_size, "Resuming with a different world_size changes the shards"
+        self.seed  = state['seed']
+        self.epoch = state['epoch']
+        self.step  = state['step']
+
+
+# Message kinds passed from the BatchPrefetcher worker thread to the consumer
+_BATCH     = 0
+_END_EPOCH = 1
+_DONE      = 2
+_ERROR     = 3
+
+class BatchPrefetcher(object):
+    """
+    Assemble the next num_prefetch batches on a background thread, into a bounded queue.
+    Wraps a batch generator, e.g. batches.gen_padded_batches(data), or with epochs=True
+    a generator of epochs, e.g. batches.gen_padded_batch_epochs(data, 10). Iterating then
+    yields one batch iterator per epoch, and prefetching carries on across epoch boundaries.
+    Exceptions raised while assembling batches are re-raised in the consumer.
+    wait_time is the total time in seconds the consumer spent waiting for batches.
+    """
+    def __init__(self, source, num_prefetch=4, epochs=False):
+        self.epochs = epochs
+        self.wait_time = 0.0
+        self.n_batches = 0
+
+        self._queue = queue.Queue(maxsize=num_prefetch)
+        self._stop = threading.Event()
+        self._pending = None        # first message of the next epoch, read ahead by _gen_epochs()
+        self._epoch_open = False    # current epoch iterator has not reached its end yet
+        self._thread = threading.Thread(target=self._worker, args=(source,), daemon=True)
+        self._thread.start()
+
+    def __iter__(self):
+        if self.epochs:
+            return self._gen_epochs()
+        return self._gen_batches()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Stop the worker thread and discard any prefetched batches."""
+        self._stop.set()
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self._thread.join()
+
+    def _worker(self, source):
+        try:
+            if self.epochs:
+                for epoch in source:
+                    for batch in epoch:
+                        if not self._put(_BATCH, batch):
+                            return
+                    if not self._put(_END_EPOCH, None):
+                        return
+            else:
+                for batch in source:
+                    if not self._put(_BATCH, batch):
+                        return
+            self._put(_DONE, None)
+        except Exception as err:
+            self._put(_ERROR, err)
+
+    def _put(self, kind, value):
+        """Block until there is room in the queue, returns False if the prefetcher was closed."""
+        while not self._stop.is_set():
+            try:
+                self._queue.put((kind, value), timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self):
+        if self._pending is not None:
+            message, self._pending = self._pending, None
+            return message
+        start = time.perf_counter()
+        message = self._queue.get()
+        self.wait_time += time.perf_counter() - start
+        kind, value = message
+        if kind == _ERROR:
+            self.close()
+            raise value
+        return message
+
+    def _gen_batches(self):
+        while True:
+            kind, value = self._get()
+            if kind != _BATCH:
+                self._epoch_open = False
+                return
+            self.n_batches += 1
+            yield value
+
+    def _gen_epochs(self):
+        while True:
+            # skip whatever the consumer left of the previous epoch
+            while self._epoch_open:
+                kind, value = self._get()
+                self._epoch_open = kind == _BATCH
+            message = self._get()
+            if message[0] == _DONE:
+                return
+            self._pending = message
+            # open before the consumer starts it, so an epoch it never iterates is still skipped
+            self._epoch_open = True
+            yield self._gen_batches()
+
+
+class TokenCorpus(object):
+    """
+    Token-id corpus stored once as a flat int32 buffer plus int64 offsets.
+    Sequence i is tokens[offsets[i]:offsets[i+1]] with label labels[i].
+    """
+    def __init__(self, tokens, offsets, labels):
+        self.tokens  = np.asarray(tokens, dtype=np.int32)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.labels  = np.asarray(labels)
+        self.lengths = np.diff(self.offsets)
+
+    @classmethod
+    def from_data(cls, data):
+        """Build from a list of (token_ids, label) examples, as passed to gen_padded_batches()."""
+        n_data = len(data)
+        lengths = np.fromiter((len(x) for x, _ in data), dtype=np.int64, count=n_data)
+        offsets = np.zeros(n_data + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        tokens = np.fromiter(chain.from_iterable(x for x, _ in data), dtype=np.int32, count=offsets[-1])
+        labels = np.array([y for _, y in data])
+        return cls(tokens, offsets, labels)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def gather(self, indexes, pad_sym=0, out=None):
+        """
+        Fill the sequences at indexes into a (len(indexes), max_len) array padded with pad_sym.
+        Returns the padded array, the lengths array and the labels array.
+        The array is new for each batch by default, as batches handed out by BatchPrefetcher are
+        still queued while the next ones are gathered. A consumer using one batch at a time can
+        pass a preallocated out buffer of at least (batch_size, lengths.max()) and get a view of it.
+        """
+        lengths = self.lengths[indexes]
+        max_len = lengths.max() if len(lengths) else 0
+        if out is None:
+            batch = np.full((len(lengths), max_len), pad_sym, dtype=np.int32)
+        else:
+            batch = out[:len(lengths), :max_len]
+            batch.fill(pad_sym)
+
+        # flat buffer position of every real token, in row-major batch order
+        row_starts = self.offsets[indexes] - (np.cumsum(lengths) - lengths)
+        positions  = np.repeat(row_starts, lengths) + np.arange(lengths.sum())
+        batch[np.arange(max_len) < lengths[:, None]] = self.tokens[positions]
+        return batch, lengths, self.labels[indexes]
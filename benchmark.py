@@ -0,0 +1,280 @@
+# Benchmark the data pipeline on synthetic Iris, Task and Spooky shaped datasets.
+# Each stage is timed, and its peak memory traced with tracemalloc, results go to a JSON file:
+#
+#   python benchmark.py --rows 1000 100000 --output benchmark.json
+#   python benchmark.py --rows 1000 100000 --output new.json --compare benchmark.json
+#
+# Datasets are generated in a temporary working directory, which is removed afterwards.
+import argparse
+import contextlib
+import csv
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from datamanager import *
+from vocabulary import *
+from batches import *
+from logger import *
+
+
+IRIS_LABELS    = ['Iris-setosa', 'Iris-versicolor', 'Iris-virginica']
+SPOOKY_AUTHORS = ['EAP', 'HPL', 'MWS']
+
+
+# Synthetic datasets
+def write_iris(filepath, n_rows, rng, chunk_size=100000):
+    """Rows of "property_1, property_2, property_3, property_4, label_name", no header."""
+    with open(filepath, 'w') as f:
+        for start in range(0, n_rows, chunk_size):
+            n_chunk = min(chunk_size, n_rows - start)
+            features = rng.uniform([4.3, 2.0, 1.0, 0.1], [7.9, 4.4, 6.9, 2.5], size=(n_chunk, 4))
+            labels = rng.integers(0, len(IRIS_LABELS), n_chunk)
+            f.writelines('{:.1f},{:.1f},{:.1f},{:.1f},{}\n'.format(*row, IRIS_LABELS[label])
+                         for row, label in zip(features.tolist(), labels.tolist()))
+
+def write_task(filepath, n_rows, rng, chunk_size=100000, n_classes=4):
+    """Header "idx,x,y,label", then rows of index, two properties and a float label index."""
+    with open(filepath, 'w') as f:
+        f.write('idx,x,y,label\n')
+        for start in range(0, n_rows, chunk_size):
+            n_chunk = min(chunk_size, n_rows - start)
+            features = rng.uniform(0, 1, size=(n_chunk, 2))
+            labels = rng.integers(0, n_classes, n_chunk)
+            f.writelines('{},{:.6f},{:.6f},{:.1f}\n'.format(start + i, x, y, label)
+                         for i, ((x, y), label) in enumerate(zip(features.tolist(), labels.tolist())))
+
+def sentence_lengths(n_sentences, rng, mean_length=20, distribution='lognormal'):
+    """Number of words of each sentence, at least 1, with the given mean."""
+    if distribution == 'constant':
+        lengths = np.full(n_sentences, mean_length)
+    elif distribution == 'uniform':
+        lengths = rng.integers(1, 2 * mean_length, n_sentences)
+    elif distribution == 'poisson':
+        lengths = rng.poisson(mean_length, n_sentences)
+    elif distribution == 'lognormal':
+        sigma = 0.75  # long tail, as in natural text
+        lengths = rng.lognormal(np.log(mean_length) - sigma**2 / 2, sigma, n_sentences)
+    else:
+        raise ValueError("Unknown sentence length distribution: {}".format(distribution))
+    return np.maximum(lengths.astype(np.int64), 1)
+
+def write_spooky(filepath, n_rows, rng, chunk_size=100000, mean_length=20, distribution='lognormal',
+                 vocabulary_size=50000):
+    """
+    Header "id,text,author", then quoted sentences of Zipf distributed words, with punctuation,
+    digits and commas, and some sentences spanning two lines.
+    """
+    words = np.array(['w{}'.format(i) for i in range(vocabulary_size)] + ['1984', 'x2.5', 'n07'])
+    punctuation = np.array(['', '', '', ',', '.', '!'])
+    with open(filepath, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['id', 'text', 'author'])
+        for start in range(0, n_rows, chunk_size):
+            n_chunk = min(chunk_size, n_rows - start)
+            lengths = sentence_lengths(n_chunk, rng, mean_length, distribution)
+            word_ids = (rng.zipf(1.2, lengths.sum()) - 1) % len(words)
+            tokens = np.char.add(words[word_ids], punctuation[rng.integers(0, len(punctuation), len(word_ids))])
+            ends = np.cumsum(lengths)
+            authors = rng.integers(0, len(SPOOKY_AUTHORS), n_chunk)
+            multiline = rng.random(n_chunk) < 0.01
+            for i in range(n_chunk):
+                text = ' '.join(tokens[ends[i] - lengths[i] : ends[i]].tolist())
+                if multiline[i]:
+                    text += '\nsecond line'
+                writer.writerow(['id{:08d}'.format(start + i), text, SPOOKY_AUTHORS[authors[i]]])
+
+
+# Measurements
+class Benchmark(object):
+    """Run stages, recording their time and peak traced memory as rows of results."""
+    def __init__(self, trace_memory=True, verbose=False):
+        self.trace_memory = trace_memory
+        self.results = []
+        self._devnull = None if verbose else open(os.devnull, 'w')
+
+    def run(self, dataset, n_rows, stage, fn, items=None):
+        """Run fn() as a stage, items is the number of items it processes (default n_rows)."""
+        if self.trace_memory:
+            tracemalloc.start()
+        with self.quiet():
+            start = time.perf_counter()
+            out = fn()
+            seconds = time.perf_counter() - start
+        peak_bytes = None
+        if self.trace_memory:
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        items = n_rows if items is None else items
+        result = {'dataset': dataset, 'rows': n_rows, 'stage': stage, 'seconds': seconds, 'items': items,
+                  'items_per_sec': items / seconds if seconds else None, 'peak_bytes': peak_bytes}
+        self.results.append(result)
+        print('{:8s} {:>10d} {:24s} {:10.4f}s {:>14} items/s {:>14} peak bytes'.format(
+            dataset, n_rows, stage, seconds,
+            '{:.0f}'.format(result['items_per_sec']) if seconds else '-',
+            peak_bytes if peak_bytes is not None else '-'))
+        return out
+
+    def quiet(self):
+        """Hide the progress messages of the library, unless verbose."""
+        if self._devnull is None:
+            return contextlib.nullcontext()
+        return contextlib.redirect_stdout(self._devnull)
+
+
+def bench_numeric(bench, timer, name, manager_class, filepath, n_rows, split, seed):
+    def new_manager():
+        return manager_class(filepath, split, seed=seed, timer=timer)
+
+    shutil.rmtree('data', ignore_errors=True)
+    data_manager = new_manager()
+    bench.run(name, n_rows, 'init_dataset', data_manager.init_dataset)
+    bench.run(name, n_rows, 'prepare_train', data_manager.prepare_train)
+    bench.run(name, n_rows, 'split_data', lambda: split_data(data_manager))
+
+    # second run reads the split files, or their binary cache
+    data_manager = new_manager()
+    bench.run(name, n_rows, 'init_dataset_existing', data_manager.init_dataset)
+    bench.run(name, n_rows, 'prepare_train_existing', data_manager.prepare_train)
+
+def split_data(data_manager):
+    if isinstance(data_manager.data_raw, ArraySplit):
+        return data_manager._split_indexes(data_manager.data_raw.labels)
+    return data_manager._split_data(data_manager.data_raw)
+
+def bench_spooky(bench, timer, filepath, n_rows, split, seed, num_epochs, batch_size):
+    name = 'spooky'
+    shutil.rmtree('data', ignore_errors=True)
+    data_manager = SpookyData(filepath, split, one_hot_encode=False, output_numpy=False, seed=seed, timer=timer)
+    bench.run(name, n_rows, 'init_dataset', data_manager.init_dataset)
+    train_x, train_y = bench.run(name, n_rows, 'prepare_train', data_manager.prepare_train)
+    bench.run(name, n_rows, 'split_data', lambda: split_data(data_manager))
+
+    n_train = len(train_x)
+    vocab = Vocabulary('data/vocabulary', 20000, timer=timer)
+    bench.run(name, n_rows, 'build_sentence_vocabulary', lambda: vocab.build_sentence_vocabulary(train_x),
+              items=n_train)
+    train_x_tok = bench.run(name, n_rows, 'data_to_token_ids', lambda: vocab.data_to_token_ids(train_x, 'train'),
+                            items=n_train)
+    with bench.quiet():
+        vocab.build_label_vocabulary(train_y)
+        vocab.get_label_vocabulary()
+        train_y_tok = vocab.labels_to_token_ids(train_y, 'train')
+    train_set = list(zip(train_x_tok, train_y_tok))
+
+    def run_epochs(batches, data):
+        for epoch in batches.gen_padded_batch_epochs(data, num_epochs):
+            for _ in epoch:
+                pass
+
+    batches = Batches(batch_size, seed=seed, timer=timer)
+    bench.run(name, n_rows, 'batches_padded_epochs', lambda: run_epochs(batches, train_set),
+              items=num_epochs * n_train)
+    corpus = TokenCorpus.from_data(train_set)
+    batches = Batches(batch_size, seed=seed, timer=timer)
+    bench.run(name, n_rows, 'batches_array_epochs', lambda: run_epochs(batches, corpus),
+              items=num_epochs * n_train)
+
+
+def compare(results, baseline_path, tolerance):
+    """Print the time ratio of each stage to the baseline run, flagging ratios above tolerance."""
+    with open(baseline_path) as f:
+        baseline = {(r['dataset'], r['rows'], r['stage']): r for r in json.load(f)['results']}
+    n_regressions = 0
+    print('\nCompared to {}'.format(baseline_path))
+    for result in results:
+        base = baseline.get((result['dataset'], result['rows'], result['stage']))
+        if base is None or not base['seconds']:
+            continue
+        ratio = result['seconds'] / base['seconds']
+        flag = ''
+        if ratio > tolerance:
+            flag = '  REGRESSION'
+            n_regressions += 1
+        print('{:8s} {:>10d} {:24s} {:8.3f}x time{}'.format(result['dataset'], result['rows'], result['stage'],
+                                                            ratio, flag))
+    return n_regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the data pipeline on synthetic datasets.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000],
+                        help='dataset sizes in rows, e.g. 1000 100000 10000000')
+    parser.add_argument('--datasets', nargs='+', default=['iris', 'task', 'spooky'],
+                        choices=['iris', 'task', 'spooky'])
+    parser.add_argument('--sentence-length', type=int, default=20, help='mean words per sentence')
+    parser.add_argument('--length-distribution', default='lognormal',
+                        choices=['lognormal', 'poisson', 'uniform', 'constant'])
+    parser.add_argument('--epochs', type=int, default=2, help='epochs of batches to assemble')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip tracemalloc, which slows down Python code, for cleaner timings')
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', help='earlier output file to compare stage times against')
+    parser.add_argument('--tolerance', type=float, default=1.2,
+                        help='time ratio to the baseline above which a stage is reported as a regression')
+    parser.add_argument('--verbose', action='store_true', help='show progress messages of the library')
+    args = parser.parse_args()
+
+    output_path = os.path.abspath(args.output)
+    split = (0.8, 0.1, 0.1)
+    bench = Benchmark(trace_memory=not args.no_memory, verbose=args.verbose)
+    stage_totals = []
+
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='data_tools_benchmark_')
+    os.chdir(workdir)  # datasets write to ./data/
+    try:
+        for n_rows in args.rows:
+            rng = np.random.default_rng([args.seed, n_rows])
+            for dataset in args.datasets:
+                timer = StageTimer()
+                filepath = os.path.join(workdir, '{}_{}.csv'.format(dataset, n_rows))
+                start = time.perf_counter()
+                if dataset == 'iris':
+                    write_iris(filepath, n_rows, rng)
+                    bench_numeric(bench, timer, 'iris', IrisData, filepath, n_rows, split, args.seed)
+                elif dataset == 'task':
+                    write_task(filepath, n_rows, rng)
+                    bench_numeric(bench, timer, 'task', TaskData, filepath, n_rows, split, args.seed)
+                else:
+                    write_spooky(filepath, n_rows, rng, mean_length=args.sentence_length,
+                                 distribution=args.length_distribution)
+                    bench_spooky(bench, timer, filepath, n_rows, split, args.seed, args.epochs, args.batch_size)
+                print('{:8s} {:>10d} done in {:.1f}s'.format(dataset, n_rows, time.perf_counter() - start))
+
+                for stage, (calls, seconds, items, n_bytes) in timer.stages.items():
+                    stage_totals.append({'dataset': dataset, 'rows': n_rows, 'stage': stage, 'calls': calls,
+                                         'seconds': seconds, 'items': items, 'bytes': n_bytes})
+                os.remove(filepath)
+                shutil.rmtree('data', ignore_errors=True)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': sys.version.split()[0], 'numpy': np.__version__, 'platform': platform.platform(),
+              'trace_memory': not args.no_memory, 'args': vars(args),
+              'results': bench.results, 'pipeline_stages': stage_totals}
+    with open(output_path, 'w') as f:
+        json.dump(report, f, indent=1)
+    print('Results written to {}'.format(output_path))
+
+    if args.compare:
+        n_regressions = compare(bench.results, args.compare, args.tolerance)
+        if n_regressions:
+            print('{} stages slower than {:.2f}x the baseline'.format(n_regressions, args.tolerance))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,151 @@
 import os
 import numpy as np
 import csv
-import copy
-from random import randint
-from random import shuffle
+import hashlib
+import io
+import json
+import locale
+from itertools import chain, islice
+from multiprocessing import Pool
+
+try:
+    from .logger import timed_stage
+except ImportError:  # imported as a top-level module, as in check.py
+    from logger import timed_stage
+
+
+def _find_row_starts(filepath, targets):
+    """
+    Byte offsets of the first CSV row starting at or after each of the sorted target offsets.
+    Quote parity is tracked from the start of the file, so newlines inside quoted fields are skipped.
+    """
+    row_starts = []
+    targets = iter(targets)
+    target = next(targets, None)
+    in_quotes = False
+    offset = 0  # file offset of the current block
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            if target is None:
+                break
+            pos = 0
+            while target is not None:
+                stop = min(max(target - offset, pos), len(block))
+                in_quotes ^= block.count(b'"', pos, stop) % 2 == 1
+                pos = stop
+                newline = block.find(b'\n', pos)
+                if newline < 0:
+                    break
+                in_quotes ^= block.count(b'"', pos, newline) % 2 == 1
+                pos = newline + 1
+                if not in_quotes:
+                    row_starts.append(offset + pos)
+                    target = next(targets, None)
+            in_quotes ^= block.count(b'"', pos) % 2 == 1
+            offset += len(block)
+    return row_starts
+
+def _import_chunk(manager, filepath, start, end):
+    """
+    Process the raw rows in bytes [start, end) of filepath in a worker, with fresh label state.
+    Returns the rows and the labels and indexes the worker assigned, in order of assignment.
+    """
+    manager.label_to_idx, manager.idx_to_label, manager.indexes = {}, {}, set()
+    manager.num_classes = 0
+    with open(filepath, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    rows = [manager._process_row_raw(row) for row in _csv_rows(data, manager.discard_header and start == 0)]
+    return rows, list(manager.idx_to_label.items()), list(manager.indexes)
+
+def _csv_rows(data, discard_header=False):
+    """Non-empty CSV rows of raw bytes, decoded as open() does, with universal newlines."""
+    text = io.TextIOWrapper(io.BytesIO(data), encoding=locale.getpreferredencoding(False))
+    for i, row in enumerate(csv.reader(text)):
+        if not row:
+            continue
+        if discard_header and i == 0:
+            continue
+        yield row
+
+def _gen_row_blocks(f, block_size=1 << 20):
+    """
+    Read the binary file f from its position, which should be a row boundary, in blocks of whole
+    CSV rows: each block ends on a newline outside quoted fields. Quote parity is carried across
+    blocks, as in _find_row_starts(). Yields (block, is_tail, quotes_closed), the last block being
+    the tail after the last row boundary, quotes_closed telling if it ends outside a quoted field.
+    """
+    pending = b''
+    in_quotes = False
+    for block in iter(lambda: f.read(block_size), b''):
+        pos = 0
+        row_end = None
+        while True:
+            newline = block.find(b'\n', pos)
+            if newline < 0:
+                break
+            in_quotes ^= block.count(b'"', pos, newline) % 2 == 1
+            pos = newline + 1
+            if not in_quotes:
+                row_end = pos
+        in_quotes ^= block.count(b'"', pos) % 2 == 1
+        if row_end is None:
+            pending += block
+        else:
+            yield pending + block[:row_end], False, True
+            pending = block[row_end:]
+    yield pending, True, not in_quotes
+
+def _hash_unit(keys, seed):
+    """Map string keys to uniform floats in [0, 1), a deterministic function of key and seed."""
+    salt = '{}\0'.format(seed).encode()
+    hashes = np.fromiter((int.from_bytes(hashlib.blake2b(salt + key.encode(), digest_size=8).digest(), 'little')
+                          for key in keys), dtype=np.uint64, count=len(keys))
+    return (hashes >> np.uint64(11)) / float(1 << 53)
+
+
+class ArraySplit(object):
+    """
+    A train/valid/test split held as arrays instead of a list of rows.
+    features is a column-major (n_rows, n_features) array, so each column is one contiguous
+    typed array, and labels holds the label index (or 1-hot encoding) of each row.
+    cache_dir is the split cache directory the arrays were saved to, if any.
+    """
+    def __init__(self, features, labels, cache_dir=None):
+        self.features = features
+        self.labels = labels
+        self.cache_dir = cache_dir
+
+    def __len__(self):
+        return len(self.labels)
+
+
+class Column(object):
+    """
+    One column of a declarative dataset schema, see DataManager.schema.
+    index is the column position in the raw file, role one of 'feature', 'label', 'id' or 'text'.
+    Feature and text columns form the features, 'id' columns are only kept in the split files.
+    A 'label' column maps label names to indexes in the order of labels if given, else by
+    first appearance. With an integer dtype it already holds the label index.
+    """
+    def __init__(self, index, dtype=np.float64, role='feature', labels=None):
+        assert role in ('feature', 'label', 'id', 'text'), "Unknown column role: {}".format(role)
+        self.index = index
+        self.dtype = dtype
+        self.role = role
+        self.labels = labels
+
 
 class DataManager(object):
     """
     Class to manage data handling. Just CSV import for now.
     """
-    def __init__(self, filepath, split, one_hot_encode=True, output_numpy=True):
+    def __init__(self, filepath, split, one_hot_encode=True, output_numpy=True, seed=None,
+                 streaming=False, chunk_size=10000, mmap_outputs=False, sparse_labels=False,
+                 one_hot_dtype=np.uint8, num_workers=1, hash_split=False, timer=None):
         self.filepath = filepath
         self.split = self._check_split(split)       # train/valid/test fractions, should sum to 1
+        self.seed = seed                            # seed of the train/valid/test split, random if None
         self.label_to_idx = {}
         self.idx_to_label = {}
         self.indexes = set()
@@ -21,7 +155,22 @@ class DataManager(object):
         self.discard_header = False
         self.one_hot_encode = one_hot_encode
         self.output_numpy = output_numpy
+        self.streaming = streaming      # write split files from the raw file in chunks of chunk_size rows
+        self.chunk_size = chunk_size
+        self.split_cache = False        # keep numeric splits in a columnar binary cache, see ArraySplit
+        self.mmap_outputs = mmap_outputs  # prepare_* return read-only memmaps of the split cache
+        self.sparse_labels = sparse_labels  # keep label indexes, expand batches with labels_to_1hot()
+        self.one_hot_dtype = one_hot_dtype
+        self.num_workers = num_workers      # processes parsing byte ranges of the raw file
+        self._label_record = None       # labels and indexes seen while processing a split, in order
+        self.hash_split = hash_split    # split rows by a hash of their key, appending new raw rows
+        self.key_column = None          # raw column of the stable row key for hash_split, whole row if None
+        self.timer = timer              # StageTimer recording the time of each stage, or None
+
+        # List of Column, declared in child class instead of _process_row_raw()/_process_row_split()
+        self.schema = None
 
+        self.split_names = ['train', 'valid', 'test']
         self.num_classes = 0  # Number of classes in dataset
         self.dataset_path = './data/dataset_name'  # replace dataset_name in child class
 
@@ -31,31 +180,28 @@ class DataManager(object):
                                  'test' : os.path.join(self.dataset_path, 'test.csv')}
         if not os.path.exists(self.dataset_path):
             os.makedirs(self.dataset_path)
-        if os.path.isfile(self.split_data_paths['train']):
+        self._splits    = {}    # encoded splits, loaded on first use
+        self._split_raw = {}    # imported splits not encoded yet
+        if self.hash_split:
+            print('Ingesting new rows of {}'.format(self.filepath))
+            with timed_stage(self.timer, 'ingest') as stage:
+                stage.n_bytes = self._ingest_hashed(self.filepath)
+        elif os.path.isfile(self.split_data_paths['train']):
             print('Train/Valid/Test data found, loading...')
-            self.train_raw, self.valid_raw, self.test_raw = self._load_data()
+            if not self._load_label_meta():
+                self._split_raw = dict(zip(self.split_names, self._load_data()))
+                self._write_label_meta()
+        elif self.streaming:
+            print('Streaming Train/Valid/Test data from {}'.format(self.filepath))
+            with timed_stage(self.timer, 'stream_import') as stage:
+                self._stream_and_write_data(self.filepath)
+                stage.n_bytes = os.path.getsize(self.filepath)
+            self._write_label_meta()
         else:
             print('Preparing Train/Valid/Test data from {}'.format(self.filepath))
             imported_data = self._import_and_write_data(self.filepath)
-            self.train_raw, self.valid_raw, self.test_raw = self._load_from_raw_import(*imported_data)
-
-        # Printouts below to help with DataManager improvements
-        # print('\n\nTrain Raw\n')
-        # for tr in self.train_raw[:50]:
-        #     print(tr)
-        # print('num_classes: ', self.num_classes)
-        # print('\n\n')
-
-        if self.one_hot_encode:
-            self.train, self.valid, self.test = self._make_1hot()
-        else:
-            self.train, self.valid, self.test = (self.train_raw, self.valid_raw, self.test_raw)
-
-        # print('\n\nTrain 1-hot\n')
-        # for tr in self.train[:50]:
-        #     print(tr)
-        # print('num_classes: ', self.num_classes)
-        # print('\n\n')
+            self._split_raw = dict(zip(self.split_names, self._load_from_raw_import(*imported_data)))
+            self._write_label_meta()
 
         self.initialised = True
         print('Dataset prepared')
@@ -64,15 +210,100 @@ class DataManager(object):
 
     def prepare_train(self):
         self._initialise_check()
-        return self._prepare_split(self.train)
+        return self._prepare_split(self._get_split('train'))
 
     def prepare_valid(self):
         self._initialise_check()
-        return self._prepare_split(self.valid)
+        return self._prepare_split(self._get_split('valid'))
 
     def prepare_test(self):
         self._initialise_check()
-        return self._prepare_split(self.valid)
+        return self._prepare_split(self._get_split('test'))
+
+    def release_split(self, split_name):
+        """Free a loaded split, the next prepare_* call for it loads it again."""
+        self._splits.pop(split_name, None)
+        self._split_raw.pop(split_name, None)
+
+    @property
+    def train(self):
+        return self._get_split('train')
+
+    @property
+    def valid(self):
+        return self._get_split('valid')
+
+    @property
+    def test(self):
+        return self._get_split('test')
+
+    def _get_split(self, split_name):
+        """
+        Load and encode a split on first use and keep it until release_split().
+        Label state comes from the label metadata, so splits can be loaded in any order.
+        """
+        if split_name not in self._splits:
+            if split_name == 'all':
+                split_raw = self._load_all_splits()
+            elif split_name in self._split_raw:
+                split_raw = self._split_raw.pop(split_name)
+            else:
+                split_raw = self._load_split(self.split_data_paths[split_name])
+            self._splits[split_name] = self._encode_split(split_raw)
+        return self._splits[split_name]
+
+    def kfold_indexes(self, n_folds=10, n_repeats=1, seed=None):
+        """
+        Stratified k-fold cross-validation over all rows of the dataset, train, valid and test
+        together, repeated n_repeats times with a different shuffle (seed defaults to self.seed).
+        Yields (train_idx, valid_idx) row index arrays, for prepare_indexes().
+        The rows are loaded into arrays once, and kept until release_split('all').
+        """
+        self._initialise_check()
+        labels = self._get_split('all').labels
+        if labels.ndim > 1:
+            classes = labels.argmax(axis=1)
+        else:
+            classes = np.unique(labels, return_inverse=True)[1].ravel()
+        seed = self.seed if seed is None else seed
+        for repeat in range(n_repeats):
+            rng = np.random.default_rng(None if seed is None else [seed, repeat])
+            # deal the rows of each class in random order over the folds
+            order = rng.permutation(len(classes))
+            order = order[np.argsort(classes[order], kind='stable')]
+            folds = np.empty(len(classes), dtype=np.int64)
+            folds[order] = np.arange(len(classes)) % n_folds
+            for fold in range(n_folds):
+                yield np.flatnonzero(folds != fold), np.flatnonzero(folds == fold)
+
+    def prepare_indexes(self, indexes):
+        """X and Y of the rows at indexes of all rows, e.g. a fold of kfold_indexes(), gathered in one go."""
+        self._initialise_check()
+        all_split = self._get_split('all')
+        return self._prepare_split(ArraySplit(all_split.features[indexes], all_split.labels[indexes]))
+
+    def _load_all_splits(self):
+        """All rows of the train/valid/test split files as one ArraySplit, not encoded yet."""
+        features, labels = [], []
+        for split_name in self.split_names:
+            if split_name in self._split_raw:
+                split = self._split_raw[split_name]
+            else:
+                split = self._load_split(self.split_data_paths[split_name])
+            if not isinstance(split, ArraySplit):
+                split = ArraySplit(np.array([data_line[:-1] for data_line in split]),
+                                   np.array([data_line[-1] for data_line in split]))
+            if len(split):
+                features.append(split.features)
+                labels.append(split.labels)
+        return ArraySplit(np.concatenate(features), np.concatenate(labels))
+
+    def _encode_split(self, split_raw):
+        if self.one_hot_encode and self.sparse_labels:
+            return self._split_to_sparse(split_raw)
+        elif self.one_hot_encode:
+            return self._split_to_1hot(split_raw)
+        return split_raw
 
     def _initialise_check(self):
         if not self.initialised:
@@ -84,6 +315,10 @@ class DataManager(object):
         """
         Separate data split into X and Y and convert to numpy array.
         """
+        if isinstance(split, ArraySplit):
+            if self.output_numpy:
+                return split.features, split.labels
+            return tuple(split.features.tolist()), tuple(split.labels.tolist())
         X, Y = zip(*split)
         if self.output_numpy:
             X = np.array(X)
@@ -92,49 +327,194 @@ class DataManager(object):
 
     # Loading already split dataset files
     def _load_data(self):
-        # self.num_classes = 3
         train_raw = self._load_split(self.split_data_paths['train'])
         valid_raw = self._load_split(self.split_data_paths['valid'])
         test_raw  = self._load_split(self.split_data_paths['test'])
         return train_raw, valid_raw, test_raw
 
+    def _label_meta_path(self):
+        return os.path.join(self.dataset_path, 'labels.json')
+
+    def _write_label_meta(self):
+        """Save the label state of the split files, so init_dataset() need not load them."""
+        split_files = {}
+        for split_name, split_path in self.split_data_paths.items():
+            stat = os.stat(split_path)
+            split_files[split_name] = [stat.st_size, stat.st_mtime_ns]
+        meta = {'labels': [[label, idx] for label, idx in self.label_to_idx.items()],
+                'indexes': sorted(self.indexes), 'num_classes': self.num_classes,
+                'split_files': split_files}
+        with open(self._label_meta_path(), 'w') as f:
+            json.dump(meta, f)
+
+    def _load_label_meta(self):
+        """Restore the label state, returns False if it is missing or the split files changed."""
+        if not os.path.isfile(self._label_meta_path()):
+            return False
+        with open(self._label_meta_path()) as f:
+            meta = json.load(f)
+        for split_name, split_path in self.split_data_paths.items():
+            stat = os.stat(split_path)
+            if [stat.st_size, stat.st_mtime_ns] != meta['split_files'].get(split_name):
+                return False
+
+        for label, idx in meta['labels']:
+            self.label_to_idx[label] = idx
+            self.idx_to_label[idx]   = label
+        self.indexes.update(meta['indexes'])
+        self.num_classes = meta['num_classes']
+        return True
+
     def _load_split(self, split_path):
         """
         Import data from processed train/valid/test split datasets.
         Override _process_row_split() method in child class for final data structure.
         This should have the final format used in the Neural Network.
         """
-        split_raw = []
+        if self.split_cache:
+            cached_split = self._load_cached_split(split_path)
+            if cached_split is not None:
+                return cached_split
+        with timed_stage(self.timer, 'split_load') as stage:
+            if self.schema is not None:
+                rows = list(self._iter_csv_rows(split_path))
+                split = self._process_split(lambda: self._parse_columns(rows, split_file=True), split_path)
+            else:
+                split = self._process_split(lambda: list(self.iter_split_rows(split_path)), split_path)
+            stage.items = len(split)
+            stage.n_bytes = os.path.getsize(split_path)
+        return split
+
+    def iter_split_rows(self, split_path):
+        """Stream processed rows of a train/valid/test split file one at a time."""
         with open(split_path) as f:
             reader = csv.reader(f)
             for row in reader:
                 if not row:
                     continue
-                read_line = self._process_row_split(row)
-                split_raw.append(read_line)
-        return split_raw
+                yield self._process_row_split(row)
 
     def _load_from_raw_import(self, train_raw, valid_raw, test_raw):
-        train_load = self._load_from_raw_import_split(train_raw)
-        valid_load = self._load_from_raw_import_split(valid_raw)
-        test_load  = self._load_from_raw_import_split(test_raw)
+        train_load = self._load_from_raw_import_split(train_raw, self.split_data_paths['train'])
+        valid_load = self._load_from_raw_import_split(valid_raw, self.split_data_paths['valid'])
+        test_load  = self._load_from_raw_import_split(test_raw, self.split_data_paths['test'])
         return train_load, valid_load, test_load
 
-    def _load_from_raw_import_split(self, split):
+    def _load_from_raw_import_split(self, split, split_path):
         """
         Written file, and processed file can have different formats.
         Pass through same processing as if reading from train/valid/test files.
         """
-        split_raw = []
-        for row in split:
-            if not row:
-                continue
-            read_line = self._process_row_split(row)
-            split_raw.append(read_line)
-        return split_raw
+        if isinstance(split, ArraySplit):
+            return self._process_split(lambda: split, split_path)
+        if self.schema is not None:
+            return self._process_split(lambda: self._parse_columns([row for row in split if row], split_file=True),
+                                       split_path)
+        return self._process_split(lambda: [self._process_row_split(row) for row in split if row], split_path)
+
+    def _process_split(self, read_split, split_path):
+        """
+        Read a split with read_split(), which returns processed rows or an ArraySplit.
+        With split_cache, rows are converted to an ArraySplit and cached, together with the labels
+        they added, for the split file at split_path.
+        """
+        if not self.split_cache:
+            return read_split()
+
+        # record the labels of the split, to rebuild label state when loading from the cache
+        self._label_record = ({}, {})
+        try:
+            split = read_split()
+        finally:
+            seen_labels, seen_indexes = self._label_record
+            self._label_record = None
+
+        if isinstance(split, ArraySplit):
+            features, labels = split.features, split.labels
+            if self.schema is not None:
+                seen_labels, seen_indexes = self._schema_labels_seen(labels)
+        elif split:
+            features = np.asfortranarray([data_line[:-1] for data_line in split])
+            labels = np.array([data_line[-1] for data_line in split], dtype=np.int64)
+        else:
+            features = np.zeros((0, 0))
+            labels = np.zeros(0, dtype=np.int64)
+        cache_dir = self._split_cache_dir(split_path)
+        array_split = ArraySplit(features, labels, cache_dir)
+        self._write_split_cache(split_path, array_split, list(seen_labels.items()), list(seen_indexes))
+        if self.mmap_outputs:
+            return self._load_split_arrays(cache_dir)
+        return array_split
+
+    # Columnar binary cache of split files
+    def _split_cache_dir(self, split_path):
+        split_name = os.path.splitext(os.path.basename(split_path))[0]
+        return os.path.join(self.dataset_path, 'cache', split_name)
+
+    def _write_split_cache(self, split_path, array_split, seen_labels, seen_indexes):
+        cache_dir = self._split_cache_dir(split_path)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        np.save(os.path.join(cache_dir, 'features.npy'), array_split.features)
+        np.save(os.path.join(cache_dir, 'labels.npy'), array_split.labels)
+        if os.path.isfile(os.path.join(cache_dir, 'labels_1hot.npy')):
+            os.remove(os.path.join(cache_dir, 'labels_1hot.npy'))
+
+        stat = os.stat(split_path)
+        meta = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': self._file_digest(split_path),
+                'seen_labels': seen_labels, 'seen_indexes': seen_indexes}
+        with open(os.path.join(cache_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+    def _load_cached_split(self, split_path):
+        """
+        Load the cached ArraySplit of a split file, or None if there is no valid cache.
+        The cache is valid while the file keeps its size and mtime, or else its hash.
+        """
+        meta_path = os.path.join(self._split_cache_dir(split_path), 'meta.json')
+        if not os.path.isfile(meta_path):
+            return None
+        with open(meta_path) as f:
+            meta = json.load(f)
+        stat = os.stat(split_path)
+        if stat.st_size != meta['size']:
+            return None
+        if stat.st_mtime_ns != meta['mtime_ns']:
+            if self._file_digest(split_path) != meta['sha256']:
+                return None
+            meta['mtime_ns'] = stat.st_mtime_ns
+            with open(meta_path, 'w') as f:
+                json.dump(meta, f)
+
+        # replay the labels that processing the split file would have added
+        for label, idx in meta['seen_labels']:
+            if self.schema is not None:
+                self._set_label_idx(label, idx)
+            else:
+                self._get_idx(label)
+        for idx in meta['seen_indexes']:
+            self._count_idx(idx)
+
+        return self._load_split_arrays(self._split_cache_dir(split_path))
+
+    def _load_split_arrays(self, cache_dir):
+        """With mmap_outputs the arrays are mapped read-only, so processes can share their pages."""
+        mmap_mode = 'r' if self.mmap_outputs else None
+        features = np.load(os.path.join(cache_dir, 'features.npy'), mmap_mode=mmap_mode)
+        labels   = np.load(os.path.join(cache_dir, 'labels.npy'), mmap_mode=mmap_mode)
+        return ArraySplit(features, labels, cache_dir)
+
+    def _file_digest(self, filepath):
+        digest = hashlib.sha256()
+        with open(filepath, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
 
     # Importing from raw CSV
     def _import_and_write_data(self, filepath):
+        if self.schema is not None and self.num_workers <= 1:
+            return self._import_and_write_schema_data(filepath)
         self.data_raw = self._data_import(filepath)
         train_raw, valid_raw, test_raw = self._split_data(self.data_raw)
         self._write_split_files(train_raw, valid_raw, test_raw)
@@ -146,81 +526,172 @@ class DataManager(object):
         Override this _process_row_raw() method in child class for dataset structure.
         Return a list of [property_1, property_2, ..., target_index]
         """
+        with timed_stage(self.timer, 'csv_import') as stage:
+            if self.num_workers > 1:
+                data_raw = self._data_import_parallel(filepath)
+            else:
+                data_raw = list(self.iter_raw_rows(filepath))
+            stage.items = len(data_raw)
+            stage.n_bytes = os.path.getsize(filepath)
+        return data_raw
+
+    def _data_import_parallel(self, filepath):
+        """
+        Import the raw file in byte ranges split on row boundaries, parsed in a process pool.
+        Worker label indexes are mapped to global ones in file order, so labels, indexes and
+        row order are the same as in a serial import.
+        """
+        file_size = os.path.getsize(filepath)
+        n_chunks = 4 * self.num_workers
+        targets = [file_size * chunk_idx // n_chunks for chunk_idx in range(1, n_chunks)]
+        bounds = [0] + _find_row_starts(filepath, targets) + [file_size]
+        chunks = [(self, filepath, start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
         data_raw = []
+        with Pool(self.num_workers) as pool:
+            for rows, chunk_labels, chunk_indexes in pool.starmap(_import_chunk, chunks):
+                local_to_global = {local_idx: self._get_idx(label) for local_idx, label in chunk_labels}
+                for idx in chunk_indexes:
+                    self._count_idx(idx)
+                if any(local_idx != global_idx for local_idx, global_idx in local_to_global.items()):
+                    for data_line in rows:
+                        data_line[-1] = local_to_global[data_line[-1]]
+                data_raw.extend(rows)
+        return data_raw
+
+    def iter_raw_rows(self, filepath=None):
+        """
+        Stream processed rows of the raw data file (default self.filepath) one at a time,
+        e.g. to build a vocabulary from a corpus larger than memory.
+        """
+        for row in self._iter_csv_rows(filepath or self.filepath, self.discard_header):
+            yield self._process_row_raw(row)
+
+    def _iter_csv_rows(self, filepath, discard_header=False):
         with open(filepath) as f:
             reader = csv.reader(f)
             for i, row in enumerate(reader):
                 if not row:
                     continue
-                if self.discard_header and i == 0:
+                if discard_header and i == 0:
                     continue
-                read_line = self._process_row_raw(row)
-                data_raw.append(read_line)
-        return data_raw
+                yield row
+
+    def _stream_and_write_data(self, filepath):
+        """
+        Split the raw file into train/valid/test files in chunks of rows, with constant memory.
+        A first pass counts the rows of each class, so the split has the same per-class counts as
+        _split_data(). The second pass draws how many rows of each class in a chunk go to train
+        and valid from a hypergeometric distribution over the remaining places, which picks a
+        uniformly random subset of each class. Rows keep their file order within each split.
+        """
+        class_counts = {}
+        for chunk in self._iter_raw_chunks(filepath):
+            for data_line in chunk:
+                class_counts[data_line[-1]] = class_counts.get(data_line[-1], 0) + 1
+        class_sizes = [class_counts.get(class_idx, 0) for class_idx in range(self.num_classes)]
+        n_train, n_valid, n_test = self._get_split_counts_by_class(class_sizes)
+
+        rng = np.random.default_rng(self.seed)
+        left_rows, left_train, left_valid = list(class_sizes), list(n_train), list(n_valid)
+        split_names = ['train', 'valid', 'test']
+        cls_counts = [{name: 0 for name in split_names} for _ in class_sizes]
+        split_files = [open(os.path.join(self.dataset_path, name + '.csv'), 'w') for name in split_names]
+        try:
+            writers = [csv.writer(f, delimiter=',') for f in split_files]
+            for chunk in self._iter_raw_chunks(filepath):
+                labels = np.array([data_line[-1] for data_line in chunk], dtype=np.int64)
+                split_ids = np.full(len(chunk), 2, dtype=np.int64)
+                for class_idx in np.unique(labels):
+                    rows = rng.permutation(np.flatnonzero(labels == class_idx))
+                    n_rows, n_left = len(rows), left_rows[class_idx]
+                    to_train = rng.hypergeometric(left_train[class_idx], n_left - left_train[class_idx], n_rows)
+                    n_left -= left_train[class_idx]
+                    to_valid = rng.hypergeometric(left_valid[class_idx], n_left - left_valid[class_idx], n_rows - to_train)
+                    split_ids[rows[:to_train]] = 0
+                    split_ids[rows[to_train : to_train+to_valid]] = 1
+
+                    left_rows[class_idx]  -= n_rows
+                    left_train[class_idx] -= to_train
+                    left_valid[class_idx] -= to_valid
+                    cls_counts[class_idx]['train'] += int(to_train)
+                    cls_counts[class_idx]['valid'] += int(to_valid)
+                    cls_counts[class_idx]['test']  += int(n_rows - to_train - to_valid)
+
+                for data_line, split_id in zip(chunk, split_ids.tolist()):
+                    writers[split_id].writerow(data_line)
+        finally:
+            for f in split_files:
+                f.close()
+
+        # classes without data are not reported
+        cls_counts = [cls_count for cls_count, size in zip(cls_counts, class_sizes) if size]
+        self._print_counts(cls_counts, split_names)
+
+    def _iter_raw_chunks(self, filepath):
+        rows = self.iter_raw_rows(filepath)
+        return iter(lambda: list(islice(rows, self.chunk_size)), [])
 
     def _split_data(self, original_data):
         """
         Split data into training/validation/test sets by the rations in self.split.
-        Firstly the data is divided by class, to get an even distribution over all classes.
+        Last entry of original_data rows is expected to be the target index.
         """
-        train, valid, test = [], [], []
         n_data = len(original_data)
-        count = {'train': 0, 'valid': 0, 'test': 0}
+        labels = np.fromiter((data_line[-1] for data_line in original_data), dtype=np.int64, count=n_data)
+        train, valid, test = [[original_data[idx] for idx in split_idx] for split_idx in self._split_indexes(labels)]
+        return train, valid, test
+
+    def _split_indexes(self, labels):
+        """
+        Row indexes of the training/validation/test sets, for an array of label indexes.
+        Each class is split separately, to get an even distribution over all classes:
+        a seeded permutation of the rows of each class is cut into train/valid/test ranges.
+        """
+        with timed_stage(self.timer, 'split') as stage:
+            stage.items = len(labels)
+            return self._split_indexes_by_class(labels)
+
+    def _split_indexes_by_class(self, labels):
+        rng = np.random.default_rng(self.seed)
+        n_data = len(labels)
+
+        # row indexes grouped by class, in random order within each class
+        order = rng.permutation(n_data)
+        order = order[np.argsort(labels[order], kind='stable')]
+        class_sizes = np.bincount(labels, minlength=self.num_classes)
+        class_starts = np.cumsum(class_sizes) - class_sizes
 
-        # split by class to fill train/valid/test with even class distribution
-        data_by_class = self._split_into_classes(original_data)
         # get the number examples of each class needed for each split
         # e.g. 80% train means 80% of class 1, 80% of class 2, etc.
-        n_train, n_valid, n_test = self._get_split_counts_by_class(data_by_class)
-
-        # loop through data one class at a time
-        cls_counts = []
-        for class_idx, class_data in enumerate(data_by_class):
-            cls_count = {'train': 0, 'valid': 0, 'test': 0}
-            if not class_data:
-                continue
-            # pick through class data until empty
-            while True:
-                pop_idx = randint(0, len(class_data)-1)
-                data_line = class_data.pop(pop_idx)
-                if cls_count['train'] < n_train[class_idx]:
-                    train.append(data_line)
-                    cls_count['train'] += 1
-                elif cls_count['valid'] < n_valid[class_idx]:
-                    valid.append(data_line)
-                    cls_count['valid'] += 1
-                else:
-                    test.append(data_line)
-                    cls_count['test'] += 1
-                if len(class_data) == 0:
-                    break
-            # accumulate counts
-            for split_name in count.keys():
-                count[split_name] += cls_count[split_name]
-            cls_counts.append(cls_count)
-
-        for split_set in [train, valid, test]:
-            shuffle(split_set)
+        n_train, n_valid, n_test = [np.array(n_split, dtype=np.int64)
+                                    for n_split in self._get_split_counts_by_class(class_sizes.tolist())]
 
-        self._print_counts(cls_counts, count.keys())
+        # position of each row within its class decides its split, test takes the remainder
+        sorted_labels = labels[order]
+        position = np.arange(n_data) - class_starts[sorted_labels]
+        in_train = position < n_train[sorted_labels]
+        in_valid = ~in_train & (position < n_train[sorted_labels] + n_valid[sorted_labels])
+        in_test  = ~in_train & ~in_valid
 
-        return train, valid, test
+        split_indexes = []
+        cls_counts = [{} for _ in class_sizes]
+        for split_name, in_split in (('train', in_train), ('valid', in_valid), ('test', in_test)):
+            split_idx = order[in_split]
+            rng.shuffle(split_idx)
+            split_indexes.append(split_idx)
+            for class_idx, cls_count in enumerate(np.bincount(sorted_labels[in_split], minlength=len(class_sizes))):
+                cls_counts[class_idx][split_name] = int(cls_count)
 
-    def _split_into_classes(self, original_data):
-        """
-        Split data into separate lists by class.
-        Last entry of original_data is expected to be the target index, used to split into classes.
-        """
-        data_by_class = [[] for _ in range(self.num_classes)]
-        for data_line in original_data:
-            data_by_class[data_line[-1]].append(data_line)  # last entry should be target index
-        return copy.deepcopy(data_by_class)
+        # classes without data are not reported
+        cls_counts = [cls_count for cls_count, size in zip(cls_counts, class_sizes) if size]
+        self._print_counts(cls_counts, ['train', 'valid', 'test'])
+        return split_indexes
 
-    def _get_split_counts_by_class(self, data_by_class):
+    def _get_split_counts_by_class(self, class_sizes):
         n_splits = []
-        n_of_class = [len(class_set) for class_set in data_by_class]
         for fraction in self.split:
-            n_split = [int(num * fraction) for num in n_of_class]
+            n_split = [int(num * fraction) for num in class_sizes]
             n_splits.append(n_split)
         return n_splits
 
@@ -243,40 +714,265 @@ class DataManager(object):
 
     def _write_file(self, split_data, splitname):
         filename = os.path.join(self.dataset_path, splitname+'.csv')
-        with open(filename,'w') as f:
-            writer = csv.writer(f, delimiter=',')
-            for row in split_data:
-                writer.writerow(row)
+        with timed_stage(self.timer, 'file_write') as stage:
+            with open(filename,'w') as f:
+                writer = csv.writer(f, delimiter=',')
+                for row in split_data:
+                    writer.writerow(row)
+            stage.items = len(split_data)
+            stage.n_bytes = os.path.getsize(filename)
+
+    # Hash split with append-only ingestion
+    def _ingest_hashed(self, filepath):
+        """
+        Append the raw rows added since the last ingestion to the split files.
+        Each row goes to the split given by the hash of its key and the seed, so rows never move
+        between splits and rows ingested before are not read again. The raw file is streamed in
+        blocks of whole rows; a last row without newline is only ingested if the file is not growing.
+        The raw file is expected to only grow by appending whole rows; if it was changed otherwise,
+        everything is ingested again.
+        Splits follow the split fractions in expectation, without stratification by class.
+        Returns the number of raw bytes ingested.
+        """
+        start = self._ingest_start(filepath)
+        end = start
+        split_files = []
+        cls_counts = {}
+        split_bounds = np.cumsum(self.split[:2])
+        try:
+            with open(filepath, 'rb') as raw_file:
+                raw_file.seek(start)
+                file_size = os.path.getsize(filepath)
+
+                def gen_blocks():
+                    nonlocal end
+                    for block, is_tail, quotes_closed in _gen_row_blocks(raw_file):
+                        if is_tail and block:
+                            # a last row without newline is complete, unless the file is still being written
+                            growing = raw_file.tell() != file_size or os.path.getsize(filepath) != file_size
+                            if growing or not quotes_closed:
+                                print('Incomplete last row of {} bytes, left for the next ingestion'.format(len(block)))
+                                return
+                        end += len(block)
+                        yield block
+
+                rows = chain.from_iterable(_csv_rows(block, self.discard_header and start == 0 and i == 0)
+                                           for i, block in enumerate(gen_blocks()))
+                for chunk in iter(lambda: list(islice(rows, self.chunk_size)), []):
+                    if not split_files:
+                        split_files = [open(self.split_data_paths[name], 'a' if start else 'w')
+                                       for name in self.split_names]
+                        writers = [csv.writer(f, delimiter=',') for f in split_files]
+                    keys = [row[self.key_column] if self.key_column is not None else ','.join(row) for row in chunk]
+                    split_ids = np.searchsorted(split_bounds, _hash_unit(keys, self.seed), side='right')
+                    for row, split_id in zip(chunk, split_ids.tolist()):
+                        data_line = self._process_row_raw(row)
+                        writers[split_id].writerow(data_line)
+                        cls_count = cls_counts.setdefault(data_line[-1], {name: 0 for name in self.split_names})
+                        cls_count[self.split_names[split_id]] += 1
+        finally:
+            for f in split_files:
+                f.close()
+        if not split_files:
+            print('No new rows')
+            return 0
+
+        with open(self._ingest_state_path(), 'w') as f:
+            json.dump({'offset': end, 'tail_sha256': self._tail_digest(filepath, end),
+                       'seed': self.seed, 'split': list(self.split), 'key_column': self.key_column}, f)
+        self._write_label_meta()
+        self._print_counts([cls_counts[label] for label in sorted(cls_counts)], self.split_names)
+        return end - start
+
+    def _ingest_start(self, filepath):
+        """
+        Raw file offset up to which rows were ingested, with the label state restored.
+        0 if nothing was ingested yet or the raw file, seed, split or key changed.
+        """
+        if not os.path.isfile(self._ingest_state_path()):
+            return 0
+        with open(self._ingest_state_path()) as f:
+            state = json.load(f)
+        if [state['seed'], state['split'], state['key_column']] != [self.seed, list(self.split), self.key_column]:
+            print('Split settings changed, ingesting all rows again')
+            return 0
+        if os.path.getsize(filepath) < state['offset'] or \
+                self._tail_digest(filepath, state['offset']) != state['tail_sha256']:
+            print('Raw file changed, ingesting all rows again')
+            return 0
+        if not self._load_label_meta():
+            print('Split files changed, ingesting all rows again')
+            return 0
+        return state['offset']
+
+    def _ingest_state_path(self):
+        return os.path.join(self.dataset_path, 'ingest.json')
+
+    def _tail_digest(self, filepath, end, n_bytes=1 << 16):
+        """Hash of the last ingested bytes, to notice a raw file that was replaced."""
+        with open(filepath, 'rb') as f:
+            f.seek(max(end - n_bytes, 0))
+            return hashlib.sha256(f.read(min(end, n_bytes))).hexdigest()
+
+    # Declarative column schema
+    def _import_and_write_schema_data(self, filepath):
+        """Vectorised import, split and write of the raw file for datasets declaring a schema."""
+        with timed_stage(self.timer, 'csv_import') as stage:
+            rows = list(self._iter_csv_rows(filepath, self.discard_header))
+            data = self._parse_columns(rows, split_file=False)
+            stage.items = len(rows)
+            stage.n_bytes = os.path.getsize(filepath)
+        self.data_raw = data
+
+        splits = []
+        for split_name, split_idx in zip(['train', 'valid', 'test'], self._split_indexes(data.labels)):
+            self._write_file(self._schema_split_rows(rows, data.labels, split_idx), split_name)
+            splits.append(ArraySplit(np.asfortranarray(data.features[split_idx]), data.labels[split_idx]))
+        return splits
+
+    def _parse_columns(self, rows, split_file):
+        """
+        Vectorised parser compiled from self.schema, converts a list of CSV rows to an ArraySplit.
+        Raw file rows are read at the schema column indexes. Split file rows hold the schema
+        columns in order, followed by the label index unless the label column is an index itself.
+        """
+        self._check_schema()
+        positions = list(range(len(self.schema))) if split_file else [column.index for column in self.schema]
+        feature_columns = [(pos, column) for pos, column in zip(positions, self.schema)
+                           if column.role in ('feature', 'text')]
+        label_pos, label_column = [(pos, column) for pos, column in zip(positions, self.schema)
+                                   if column.role == 'label'][0]
+
+        feature_dtypes = [np.dtype(column.dtype) for _, column in feature_columns]
+        if all(dtype.kind in 'biuf' for dtype in feature_dtypes):
+            features_dtype = np.result_type(*feature_dtypes) if feature_dtypes else np.float64
+        else:
+            features_dtype = object
+        features = np.empty((len(rows), len(feature_columns)), dtype=features_dtype, order='F')
+        if not rows:
+            return ArraySplit(features, np.zeros(0, dtype=np.int64))
+
+        cells = list(zip(*rows))  # one tuple of strings per column
+        for col_idx, (pos, column) in enumerate(feature_columns):
+            features[:, col_idx] = np.asarray(cells[pos]).astype(column.dtype)
+
+        label_cells = np.asarray(cells[label_pos])
+        if self._label_is_index(label_column):
+            labels = label_cells.astype(np.float64).astype(np.int64)
+            for idx in np.unique(labels).tolist():
+                self._count_idx(idx)
+        elif split_file:
+            labels = np.asarray(cells[-1]).astype(np.float64).astype(np.int64)
+            names, first = np.unique(label_cells, return_index=True)
+            for name, idx in sorted(zip(names.tolist(), labels[first].tolist()), key=lambda pair: pair[1]):
+                self._set_label_idx(name, idx)
+        else:
+            names, first, inverse = np.unique(label_cells, return_index=True, return_inverse=True)
+            names = names.tolist()
+            name_idx = np.empty(len(names), dtype=np.int64)
+            for name_pos in np.argsort(first, kind='stable').tolist():
+                name_idx[name_pos] = self._schema_label_idx(names[name_pos])
+            labels = name_idx[inverse.ravel()]
+        return ArraySplit(features, labels)
+
+    def _schema_split_rows(self, rows, labels, split_idx):
+        """Split file rows for raw file rows: schema columns followed by the label index."""
+        positions = [column.index for column in self.schema]
+        if self._label_is_index(self._label_column()):
+            positions = positions[:-1]
+        return [[rows[idx][pos] for pos in positions] + [labels[idx]] for idx in split_idx.tolist()]
 
-    def _make_1hot(self):
-        train_1hot = self._split_to_1hot(self.train_raw)
-        valid_1hot = self._split_to_1hot(self.valid_raw)
-        test_1hot  = self._split_to_1hot(self.test_raw)
-        return train_1hot, valid_1hot, test_1hot
+    def _schema_labels_seen(self, labels):
+        """Labels and indexes a split of label indexes holds, as recorded in the split cache."""
+        unique_labels = np.unique(labels).tolist()
+        if self._label_is_index(self._label_column()):
+            return {}, dict.fromkeys(unique_labels)
+        return {self.idx_to_label[idx]: idx for idx in unique_labels}, {}
+
+    def _schema_label_idx(self, label):
+        label_column = self._label_column()
+        if label_column.labels is None:
+            return self._get_idx(label)
+        for idx, known_label in enumerate(label_column.labels):
+            self._set_label_idx(known_label, idx)
+        return self.label_to_idx[label]
+
+    def _label_column(self):
+        return [column for column in self.schema if column.role == 'label'][0]
+
+    def _label_is_index(self, column):
+        return np.issubdtype(np.dtype(column.dtype), np.integer)
+
+    def _check_schema(self):
+        label_columns = [column for column in self.schema if column.role == 'label']
+        assert len(label_columns) == 1, "Schema should have one label column"
+        if self._label_is_index(label_columns[0]):
+            assert self.schema[-1] is label_columns[0], "An index label column should be the last schema column"
+
+    def _set_label_idx(self, label, idx):
+        """Register a label with a known index, e.g. read back from a split file."""
+        if self._label_record is not None:
+            self._label_record[0][label] = idx
+        if label not in self.label_to_idx:
+            self.label_to_idx[label] = idx
+            self.idx_to_label[idx]   = label
+            self.num_classes = max(self.num_classes, idx + 1)
 
     def _split_to_1hot(self, split):
         """
         Makes 1-hot encoding from split dataset files.
         Expects last entry of data rows to be the target index
         """
-        split_1hot = []
-        for data_line in split:
-            one_hot = [0 for _ in range(self.num_classes)]
-            one_hot[data_line[-1]] = 1
-            split_1hot.append([data_line[:-1], one_hot])
-        return split_1hot
+        with timed_stage(self.timer, 'one_hot') as stage:
+            stage.items = len(split)
+            if isinstance(split, ArraySplit):
+                one_hot = self.labels_to_1hot(split.labels)
+                if self.mmap_outputs and split.cache_dir is not None:
+                    one_hot = self._cache_1hot(split.cache_dir, one_hot)
+                return ArraySplit(split.features, one_hot, split.cache_dir)
+
+            labels = np.fromiter((data_line[-1] for data_line in split), dtype=np.int64, count=len(split))
+            one_hot = self.labels_to_1hot(labels)
+            return [[data_line[:-1], one_hot_row] for data_line, one_hot_row in zip(split, one_hot)]
+
+    def _split_to_sparse(self, split):
+        """Separate the target index from the data rows, without encoding it."""
+        if isinstance(split, ArraySplit):
+            return split
+        return [[data_line[:-1], data_line[-1]] for data_line in split]
+
+    def labels_to_1hot(self, labels):
+        """
+        1-hot encode an array of label indexes in one gather from an identity matrix.
+        With sparse_labels, prepare_* return label indexes and batches can be expanded with this.
+        """
+        return np.eye(self.num_classes, dtype=self.one_hot_dtype)[np.asarray(labels, dtype=np.int64)]
+
+    def _cache_1hot(self, cache_dir, one_hot):
+        """Save the 1-hot labels next to the split cache and map them read-only."""
+        one_hot_path = os.path.join(cache_dir, 'labels_1hot.npy')
+        if os.path.isfile(one_hot_path):
+            cached = np.load(one_hot_path, mmap_mode='r')
+            if cached.shape == one_hot.shape and cached.dtype == one_hot.dtype:
+                return cached
+        np.save(one_hot_path, one_hot)
+        return np.load(one_hot_path, mmap_mode='r')
 
     def _get_idx(self, label):
         if label in self.label_to_idx:
-            return self.label_to_idx[label]
+            idx = self.label_to_idx[label]
         else:
-            new_idx = self.num_classes
-            self.label_to_idx[label]   = new_idx
-            self.idx_to_label[new_idx] = label
+            idx = self.num_classes
+            self.label_to_idx[label] = idx
+            self.idx_to_label[idx]   = label
             self.num_classes += 1
-            return new_idx
+        if self._label_record is not None:
+            self._label_record[0][label] = idx
+        return idx
 
     def _count_idx(self, idx):
+        if self._label_record is not None:
+            self._label_record[1][idx] = None
         if idx in self.indexes:
             return len(self.indexes)
         else:
@@ -292,60 +988,58 @@ class DataManager(object):
         """
         Import lines from raw data file.
         Returns a list of data, the last entry should be a label_id.
+        Datasets with a schema get the split file row of the schema.
         """
-        raise NotImplementedError
+        if self.schema is None:
+            raise NotImplementedError
+        self._check_schema()
+        label_column = self._label_column()
+        read_line = [row[column.index] for column in self.schema]
+        if self._label_is_index(label_column):
+            read_line[-1] = int(float(read_line[-1]))
+            self._count_idx(read_line[-1])
+        else:
+            read_line.append(self._schema_label_idx(row[label_column.index]))
+        return read_line
 
     def _process_row_split(self, row):
         """
         Import lines from train/valid/test split files.
         Returns a list of data in format used in the Neural Network, the last entry should be a label_id.
+        Datasets with a schema get their feature columns and label index.
         """
-        raise NotImplementedError
+        if self.schema is None:
+            raise NotImplementedError
+        read_line = []
+        label_idx = int(float(row[-1]))
+        for pos, column in enumerate(self.schema):
+            if column.role in ('feature', 'text'):
+                read_line.append(np.asarray(row[pos]).astype(column.dtype).item())
+            elif column.role == 'label' and self._label_is_index(column):
+                self._count_idx(label_idx)
+            elif column.role == 'label':
+                self._set_label_idx(row[pos], label_idx)
+        read_line.append(label_idx)
+        return read_line
 
 
 class IrisData(DataManager):
-    def __init__(self, filepath, split):
-        super().__init__(filepath, split)
+    def __init__(self, filepath, split, **kwargs):
+        super().__init__(filepath, split, **kwargs)
         self.filepath = filepath
         self.split = split       # train/valid/test fractions, should sum to 1
         self.num_classes = 0
         self.dataset_path = './data/iris'
+        self.split_cache = True
 
-    def _process_row_raw(self, row):
-        """
-        Import lines from raw Iris data file.
-        Imports line of "property_1, property_2, property_3, property_4, label_name"
-        Returns list of [property_1, property_2, property_3, property_4, label_index]
-        """
-        read_line = []
-        iris_properties = row[:4]
-        iris_properties = [float(prop) for prop in iris_properties]
-        iris_label = row[-1]
-        label_idx = self._get_idx(iris_label)
-        read_line.extend(iris_properties)
-        read_line.extend([iris_label, label_idx])
-        return read_line
-
-    def _process_row_split(self, row):
-        """
-        Import lines from train/valid/test split files.
-        Imports line of "property_1, property_2, property_3, property_4, label_name, label_index"
-        Returns list of [property_1, property_2, property_3, property_4, label_index]
-        """
-        read_line = []
-        iris_properties = row[:4]
-        iris_properties = [float(prop) for prop in iris_properties]
-        iris_label = row[4]
-        label_idx = int(row[-1])
-        fetch_idx = self._get_idx(iris_label)
-        read_line.extend(iris_properties)
-        read_line.append(label_idx)
-        return read_line
+        # Raw lines of "property_1, property_2, property_3, property_4, label_name"
+        self.schema = [Column(0), Column(1), Column(2), Column(3),
+                       Column(4, dtype=str, role='label')]
 
 
 class TaskData(DataManager):
-    def __init__(self, filepath, split, one_hot_encode=True, output_numpy=True):
-        super().__init__(filepath, split)
+    def __init__(self, filepath, split, one_hot_encode=True, output_numpy=True, **kwargs):
+        super().__init__(filepath, split, **kwargs)
         self.filepath = filepath
         self.split = split       # train/valid/test fractions, should sum to 1
         self.discard_header = True
@@ -353,43 +1047,22 @@ class TaskData(DataManager):
         self.output_numpy = output_numpy
 
         self.dataset_path = './data/task'
+        self.split_cache = True
+        self.key_column = 0
 
-    def _process_row_raw(self, row):
-        """
-        Import lines from raw Iris data file.
-        Imports line of "index, property_1, property_2, label_index"
-        Returns list of [property_1, property_2, label_index]
-        """
-        read_line = []
-        task_x = float(row[1])
-        task_y = float(row[2])
-        task_label = int(float(row[-1]))
-        count = self._count_idx(task_label)  # count the number of classes
-        read_line.extend([task_x, task_y, task_label])
-        return read_line
-
-    def _process_row_split(self, row):
-        """
-        Import lines from train/valid/test split files.
-        Imports line of "property_1, property_2, label_index"
-        Returns list of [property_1, property_2, label_index]
-        """
-        read_line = []
-        task_x = float(row[0])
-        task_y = float(row[1])
-        task_label = int(float(row[-1]))
-        count = self._count_idx(task_label)  # count the number of classes
-        read_line.extend([task_x, task_y, task_label])
-        return read_line
+        # Raw lines of "index, property_1, property_2, label_index"
+        self.schema = [Column(1), Column(2),
+                       Column(3, dtype=np.int64, role='label')]
 
 
 class SpookyData(DataManager):
-    def __init__(self, filepath, split, one_hot_encode=True, output_numpy=True):
-        super().__init__(filepath, split, one_hot_encode, output_numpy)
+    def __init__(self, filepath, split, one_hot_encode=True, output_numpy=True, **kwargs):
+        super().__init__(filepath, split, one_hot_encode, output_numpy, **kwargs)
         self.filepath = filepath
         self.split = split       # train/valid/test fractions, should sum to 1
         self.dataset_path = 'data/spooky_author_identification/processed'
         self.discard_header = True
+        self.key_column = 0
 
     def _process_row_raw(self, row):
         """
@@ -1,11 +1,39 @@
+import array
+import contextlib
+import math
+import queue
+import threading
+import time
+import types
+from collections import deque
+
+import numpy as np
+
+
+STEP_NAMES = ['iteration', 'step', 'gstep', 'global_step']
+
+
 class Logger(object):
-    def __init__(self, *quantities):
+    def __init__(self, *quantities, storage='list'):
+        """
+        storage='array' keeps each quantity in a typed array.array instead of a list, 'q' for
+        step counters and 'd' otherwise, compact for long runs and quick to dump_columns().
+        """
+        assert storage in ('list', 'array'), "Unknown storage: {}".format(storage)
         self.logs = {}
         self.n_quantities = len(quantities)
         self.names = quantities
+        self.storage = storage
 
         for quantity in quantities:
-            self.logs[quantity] = []
+            if storage == 'array':
+                self.logs[quantity] = array.array(self._typecode(quantity))
+            else:
+                self.logs[quantity] = []
+
+        # open CSV file of flush_csv(), and the number of rows written to it
+        self._csv_file = None
+        self._n_flushed = 0
 
     def log(self, **quantities):
         assert len(quantities) == self.n_quantities
@@ -13,30 +41,258 @@ class Logger(object):
             self.logs[name].append(val)
 
     def printlog(self):
-        rows = self._get_rows()
         for name in self.names:
             print('{:20s}'.format(name), end='')
         print()
-        for row in rows:
-            for name in self.names:
-                if name.lower() in ['iteration', 'step', 'gstep', 'global_step']:
-                    print('{:<20}'.format(row[name]), end='')
-                else:
-                    print('{:<20.6f}'.format(row[name]), end='')
+        formats = ['{:<20}' if self._is_step(name) else '{:<20.6f}' for name in self.names]
+        for row in self._iter_rows():
+            for fmt, val in zip(formats, row):
+                if isinstance(val, (str, int, np.integer)):
+                    fmt = '{:<20}'
+                print(fmt.format(val), end='')
             print()
 
     def write_csv(self, filename):
-        rows = self._get_rows()
         with open(filename,'w') as file:
-            headerline = ','.join(self.names)
-            file.write(headerline)
-            file.write('\n')
-            for row in rows:
-                writelist = [str(row[name]) for name in self.names]
-                writeline = ','.join(writelist)
-                file.write(writeline)
-                file.write('\n')
-
-    def _get_rows(self):
-        rows = [dict(zip(self.names, row)) for row in zip(*(self.logs[k] for k in self.names))]
-        return rows
+            self._write_header(file)
+            self._write_rows(file, self._iter_rows())
+
+    def flush_csv(self, filename):
+        """
+        Append the rows logged since the last flush to filename, kept open with buffered writes,
+        so periodic checkpoints of the log only cost the new rows.
+        The file is started over on the first flush, or when flushing to another file.
+        """
+        if self._csv_file is None or self._csv_file.name != filename:
+            self.close()
+            self._csv_file = open(filename, 'w')
+            self._write_header(self._csv_file)
+            self._n_flushed = 0
+        n_rows = self._n_rows()
+        self._write_rows(self._csv_file, self._iter_rows(self._n_flushed, n_rows))
+        self._csv_file.flush()
+        self._n_flushed = n_rows
+
+    def close(self):
+        """Close the file of flush_csv()."""
+        if self._csv_file is not None:
+            self._csv_file.close()
+            self._csv_file = None
+
+    def dump_columns(self, filename):
+        """Save each quantity as a numpy array in one .npz file, read back with load_columns()."""
+        np.savez(filename, **{name: self._column(name) for name in self.names})
+
+    @staticmethod
+    def load_columns(filename):
+        """Dict of quantity name to numpy array, from a file of dump_columns()."""
+        with np.load(filename) as columns:
+            return {name: columns[name] for name in columns.files}
+
+    def _column(self, name):
+        if self.storage == 'array':
+            return np.frombuffer(self.logs[name], dtype=self.logs[name].typecode)
+        return np.asarray(self.logs[name])
+
+    def _n_rows(self):
+        return min((len(self.logs[name]) for name in self.names), default=0)
+
+    def _iter_rows(self, start=0, stop=None):
+        return zip(*(self.logs[name][start:stop] for name in self.names))
+
+    def _write_header(self, file):
+        file.write(','.join(self.names))
+        file.write('\n')
+
+    def _write_rows(self, file, rows):
+        file.writelines(','.join(map(str, row)) + '\n' for row in rows)
+
+    def _typecode(self, name):
+        return 'q' if self._is_step(name) else 'd'
+
+    def _is_step(self, name):
+        return name.lower() in STEP_NAMES
+
+
+class RunningStats(object):
+    """
+    Running aggregates of one quantity, updated in constant time per value:
+    count, min, max, mean over the last window values and an exponential moving average.
+    The window sum is recomputed exactly every window updates, so rounding errors of the
+    running sum do not build up.
+    """
+    def __init__(self, window=100, ema_decay=0.99):
+        self.window = window
+        self.ema_decay = ema_decay
+        self.count = 0
+        self.min = float('inf')
+        self.max = float('-inf')
+        self.ema = None
+        self._values = deque(maxlen=window)
+        self._window_sum = 0.0
+
+    def update(self, val):
+        if len(self._values) == self.window:
+            self._window_sum -= self._values[0]
+        self._values.append(val)
+        self._window_sum += val
+        self.count += 1
+        if self.count % self.window == 0:
+            self._window_sum = math.fsum(self._values)
+        self.min = min(self.min, val)
+        self.max = max(self.max, val)
+        if self.ema is None:
+            self.ema = val
+        else:
+            self.ema = self.ema_decay * self.ema + (1 - self.ema_decay) * val
+
+    @property
+    def mean(self):
+        """Mean of the last window values."""
+        if not self._values:
+            return None
+        return self._window_sum / len(self._values)
+
+    def as_dict(self):
+        return {'count': self.count, 'mean': self.mean, 'ema': self.ema, 'min': self.min, 'max': self.max}
+
+
+class AsyncLogger(Logger):
+    """
+    Logger whose log() only puts the quantities on a bounded queue, drained by a writer thread
+    that stores them and updates a RunningStats per quantity, see aggregates().
+    log() blocks when max_queue entries are waiting. Reading or writing the logs first waits
+    for the queue to drain. Call close(), or use it as a context manager, to stop the thread.
+    Exceptions of the writer thread are re-raised by the next call.
+    """
+    def __init__(self, *quantities, storage='list', max_queue=10000, window=100, ema_decay=0.99):
+        super().__init__(*quantities, storage=storage)
+        self.stats = {quantity: RunningStats(window, ema_decay) for quantity in quantities}
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()   # held by the writer while it updates logs and stats
+        self._error = None
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def log(self, **quantities):
+        assert len(quantities) == self.n_quantities
+        self._check_error()
+        self._queue.put(quantities)
+
+    def aggregates(self, name):
+        """Running count, window mean, ema, min and max of a quantity, as logged so far."""
+        with self._lock:
+            return self.stats[name].as_dict()
+
+    def wait(self):
+        """Block until all logged quantities are stored."""
+        self._queue.join()
+        self._check_error()
+
+    def printlog(self):
+        self.wait()
+        super().printlog()
+
+    def write_csv(self, filename):
+        self.wait()
+        super().write_csv(filename)
+
+    def flush_csv(self, filename):
+        self.wait()
+        super().flush_csv(filename)
+
+    def dump_columns(self, filename):
+        self.wait()
+        super().dump_columns(filename)
+
+    def close(self):
+        """Store what is left on the queue, stop the writer thread and close the file of flush_csv()."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        super().close()
+        self._check_error()
+
+    def _writer(self):
+        while True:
+            quantities = self._queue.get()
+            try:
+                if quantities is None:
+                    return
+                with self._lock:
+                    super().log(**quantities)
+                    for name, val in quantities.items():
+                        self.stats[name].update(val)
+            except Exception as err:
+                self._error = err
+            finally:
+                self._queue.task_done()
+
+    def _check_error(self):
+        if self._error is not None:
+            err, self._error = self._error, None
+            raise err
+
+
+class StageTimer(object):
+    """
+    Wall time, item and byte counts of the stages of a data pipeline, summed over calls.
+    Pass it as timer= to DataManager, Vocabulary or Batches, read it back with to_logger().
+    Stages are timed with a context manager, setting the counts on the stage it returns:
+        with timer.stage('csv_import') as stage:
+            rows = ...
+            stage.items = len(rows)
+    """
+    def __init__(self):
+        self.stages = {}  # stage name: [calls, seconds, items, bytes]
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def record(self, name, seconds, items=0, n_bytes=0):
+        totals = self.stages.setdefault(name, [0, 0.0, 0, 0])
+        totals[0] += 1
+        totals[1] += seconds
+        totals[2] += items
+        totals[3] += n_bytes
+
+    def to_logger(self):
+        """Logger with a row of calls, seconds, items, items/sec and bytes per stage."""
+        logger = Logger('stage', 'calls', 'seconds', 'items', 'items_per_sec', 'bytes')
+        for name, (calls, seconds, items, n_bytes) in self.stages.items():
+            items_per_sec = items / seconds if seconds else 0.0
+            logger.log(stage=name, calls=calls, seconds=seconds, items=items,
+                       items_per_sec=items_per_sec, bytes=n_bytes)
+        return logger
+
+    def printlog(self):
+        self.to_logger().printlog()
+
+
+def timed_stage(timer, name):
+    """Time a stage with timer, a StageTimer, or record nothing if timer is None."""
+    if timer is None:
+        return contextlib.nullcontext(types.SimpleNamespace())
+    return timer.stage(name)
+
+
+class _Stage(object):
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+        self.items = 0
+        self.n_bytes = 0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timer.record(self.name, time.perf_counter() - self._start, self.items, self.n_bytes)
@@ -2,8 +2,24 @@
 Class for building and managing vocabulary for NLP.
 Based on some TensorFlow data_utils.
 """
+import hashlib
+import heapq
 import os.path
 import re
+import shutil
+import struct
+from array import array
+from collections import deque
+from functools import partial
+from itertools import chain, islice
+from multiprocessing import Pool
+
+import numpy as np
+
+try:
+    from .logger import timed_stage
+except ImportError:  # imported as a top-level module, as in check.py
+    from logger import timed_stage
 
 # String to use for padding or unknown token
 _PAD = "_PAD"
@@ -22,15 +38,135 @@ UNK_ID_dict['no_padding'] = 0
 # Regular expressions used to tokenize.
 _WORD_SPLIT = re.compile("([.,!?\"':;)(])")
 _DIGIT_RE = re.compile(r"\d")
+# Single pattern giving the same tokens as basic_tokeniser: a punctuation mark, or a run of other non-space
+_TOKEN_RE = re.compile("[.,!?\"':;)(]|[^\\s.,!?\"':;)(]+")
+
+def _count_tokens(tokeniser, sentences, normalise_digits=True, report_every=0):
+    """Count occurrences of each word, words are kept in first-seen order"""
+    vocab = {}
+    for counter, sentence in enumerate(sentences, 1):
+        if report_every and counter % report_every == 0:
+            print("  processing line {}".format(counter))
+        tokens = tokeniser(sentence)
+        for w in tokens:
+            word = re.sub(_DIGIT_RE, "0", w) if normalise_digits else w
+            if word in vocab:
+                vocab[word] += 1
+            else:
+                vocab[word] = 1
+    return vocab
+
+# Tokeniser of the count worker processes, set once per process by the Pool initializer
+_worker_tokeniser = None
+
+def _init_count_worker(tokeniser):
+    global _worker_tokeniser
+    _worker_tokeniser = tokeniser
+
+def _count_chunk(sentences, normalise_digits):
+    return _count_tokens(_worker_tokeniser, sentences, normalise_digits)
+
+# Binary token ID files: header, then int64 offsets, int32 token IDs and int32 label IDs
+_IDS_MAGIC = b"DTIDS001"
+_IDS_HEADER = struct.Struct("<8sqqq32s")  # magic, vocab_size, n_examples, n_tokens, sha256 of the inputs
+
+def iter_lines(filename):
+    """Stream the lines of a text file, e.g. a sentence corpus, without their line endings"""
+    with open(filename) as file:
+        for line in file:
+            yield line.rstrip("\n")
+
+class _LineFile(object):
+    """Lines of a text file as by iter_lines(), but iterable any number of times"""
+    def __init__(self, filename):
+        self.filename = filename
+
+    def __iter__(self):
+        return iter_lines(self.filename)
+
+def _write_through(lines, file):
+    """Yield lines unchanged, writing each one to file as it passes"""
+    for line in lines:
+        file.write(str(line) + "\n")
+        yield line
+
+def _count_through(lines, stage):
+    """Yield lines, counting them in stage.items"""
+    for line in lines:
+        stage.items += 1
+        yield line
+
+def _hash_through(lines, digest):
+    """Yield lines unchanged, adding each one to the hashlib digest as it passes"""
+    for line in lines:
+        digest.update(str(line).encode() + b"\n")
+        yield line
+
+def _memmap(filename, dtype, offset, length):
+    if length == 0:  # np.memmap cannot map an empty range
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=(length,))
+
+class VocabularyCache(object):
+    """
+    Content-addressed store of vocabulary and tokenisation results, one directory per key.
+    Least recently used entries are evicted once the cache holds more than max_bytes.
+    """
+    def __init__(self, cachedir, max_bytes):
+        self.cachedir = cachedir
+        self.max_bytes = max_bytes
+        if not os.path.exists(self.cachedir):
+            os.makedirs(self.cachedir)
+
+    def get(self, key):
+        """Directory of the entry for key, or None on a cache miss"""
+        entry = os.path.join(self.cachedir, key)
+        if not os.path.isdir(entry):
+            return None
+        os.utime(entry)  # mark as recently used
+        return entry
+
+    def new_entry(self, key):
+        """Empty directory to write the files of an entry into, before commit()"""
+        tmp_entry = os.path.join(self.cachedir, '{}.tmp{}'.format(key, os.getpid()))
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        os.makedirs(tmp_entry)
+        return tmp_entry
+
+    def commit(self, key, tmp_entry):
+        entry = os.path.join(self.cachedir, key)
+        if os.path.isdir(entry):
+            shutil.rmtree(tmp_entry)
+        else:
+            os.rename(tmp_entry, entry)
+        self.evict()
+        return entry
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cachedir):
+            entry = os.path.join(self.cachedir, name)
+            if '.tmp' in name or not os.path.isdir(entry):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), size, entry))
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            print('Evicting cache entry {}'.format(entry))
+            shutil.rmtree(entry)
+            total -= size
 
 class Vocabulary(object):
-    def __init__(self, datadir, max_vocabulary_size):
+    def __init__(self, datadir, max_vocabulary_size, cache_max_bytes=None, timer=None):
         self.datadir = datadir
         if not os.path.exists(self.datadir):
             os.makedirs(self.datadir)
         self.max_vocabulary_size = max_vocabulary_size
         self.corpus_file        = 'sentences_raw.txt'
         self.vocab_file         = 'vocab_sentences.txt'
+        self.counts_file        = 'vocab_counts.tsv'
         self.label_file         = 'vocab_labels.txt'
 
         # train/valid/test file names
@@ -38,66 +174,199 @@ class Vocabulary(object):
         self.labels_file        = 'labels.txt'
         self.ids_sentences_file = 'ids_sentences.txt'
         self.ids_labels_file    = 'ids_labels.txt'
+        self.ids_binary_file    = 'ids.bin'
+        self.ids_key_file       = 'ids_key.txt'  # cache key of the token IDs written in the split
+
+        # Content-addressed cache of vocabularies and token IDs, disabled when cache_max_bytes is None
+        self.cache = None
+        if cache_max_bytes is not None:
+            self.cache = VocabularyCache(os.path.join(self.datadir, 'cache'), cache_max_bytes)
 
         self.tokeniser = self.basic_tokeniser
+        self.timer = timer  # StageTimer recording the time of each stage, or None
 
         self.vocab_list = []
         self.label_list = []
+        self.vocab_counts = {}  # full word frequency table, words in first-seen order
 
         self.vocab_to_id = {}
         self.id_to_vocab = []
         self.label_to_id = {}
         self.id_to_label = []
 
+        # raw token > id caches of encode_sentences(), one per (UNK_ID, normalise_digits)
+        self.encode_cache_size = 200000
+        self._encode_caches = {}
+
     def build_vocabulary(self, sentences, labels):
         self.build_sentence_vocabulary(sentences)
         self.build_label_vocabulary(labels)
 
-    def build_sentence_vocabulary(self, sentences, normalise_digits=True):
-        """Build vocabulary from a list of sentences"""
-        # write sentences (corpus) to file
+    def build_sentence_vocabulary(self, sentences, normalise_digits=True, num_workers=1, chunk_size=20000):
+        """
+        Build vocabulary from any iterable of sentences, e.g. a list, the path of a text file with a
+        sentence per line, or a generator over DataManager.iter_raw_rows(). Sentences are streamed,
+        the corpus file is written in the same pass, so memory is bounded by the vocabulary rather
+        than the corpus. With num_workers > 1, chunks of chunk_size sentences are counted in a process pool.
+        The cache is looked up before counting, which needs a list or a file path: one-shot iterators
+        such as iter_lines(path) cannot be read twice, so they are always counted and never cached.
+        """
+        if isinstance(sentences, str):
+            sentences = _LineFile(sentences)
+
+        # write sentences (corpus) to file while they are counted
         sentences_raw_path = os.path.join(self.datadir, self.corpus_file)
-        if not os.path.exists(sentences_raw_path):
+        write_corpus = not os.path.exists(sentences_raw_path)
+        if write_corpus:
             print('Creating sentence corpus in {}'.format(sentences_raw_path))
-            self._write_file_from_list(sentences_raw_path, sentences)
 
-        # Build vocabulary from list
+        # Look up the corpus in the cache, a file is hashed in a first pass over its lines
+        digest = None
+        if self.cache is not None and iter(sentences) is not sentences:
+            digest = self._corpus_digest(normalise_digits)
+            for _ in _hash_through(sentences, digest):
+                pass
+            entry = self.cache.get(digest.hexdigest())
+            if entry is not None:
+                print('Vocabulary found in cache {}'.format(entry))
+                if write_corpus:
+                    self._write_file_from_list(sentences_raw_path, sentences)
+                self._set_counts(self.load_counts(os.path.join(entry, self.counts_file)))
+                return
+
+        # Build vocabulary from sentences
         print("Building vocabulary")
-        counter = 0
-        vocab = {}  # Count occurrences of each word
-        for sentence in sentences:
-            counter += 1
-            if counter % 5000 == 0:
-                print("  processing line {}".format(counter))
-            tokens = self.tokeniser(sentence)
-            for w in tokens:
-                word = re.sub(_DIGIT_RE, "0", w) if normalise_digits else w
-                if word in vocab:
-                    vocab[word] += 1
-                else:
-                    vocab[word] = 1
-        vocab_list = START_VOCAB_dict['with_padding'] + sorted(vocab, key=vocab.get, reverse=True)
-        if len(vocab_list) > self.max_vocabulary_size:
-            vocab_list = vocab_list[:self.max_vocabulary_size]
+        with timed_stage(self.timer, 'vocab_build') as stage:
+            if self.timer is not None:
+                sentences = _count_through(sentences, stage)
+            vocab = self._count_corpus(sentences, normalise_digits, num_workers, chunk_size, write_corpus, 'w')
+            self._set_counts(vocab)
+
+        if digest is not None:
+            key = digest.hexdigest()
+            tmp_entry = self.cache.new_entry(key)
+            shutil.copyfile(os.path.join(self.datadir, self.counts_file), os.path.join(tmp_entry, self.counts_file))
+            self.cache.commit(key, tmp_entry)
+
+    def update_vocabulary(self, new_sentences, normalise_digits=True, num_workers=1, chunk_size=20000):
+        """
+        Add the counts of new sentences to the persisted frequency table and recompute the vocabulary,
+        without recounting earlier data. The sentences are appended to the corpus file.
+        The vocabulary is identical to building it from the whole corpus at once.
+        """
+        vocab = self.vocab_counts or self.load_counts()
+        print("Updating vocabulary")
+        new_vocab = self._count_corpus(new_sentences, normalise_digits, num_workers, chunk_size, True, 'a')
+        for word, count in new_vocab.items():
+            vocab[word] = vocab.get(word, 0) + count
+        self._set_counts(vocab)
+
+    def load_counts(self, counts_path=None):
+        """Load the word frequency table saved by build_sentence_vocabulary() or update_vocabulary()"""
+        counts_path = counts_path or os.path.join(self.datadir, self.counts_file)
+        vocab = {}
+        with open(counts_path) as file:
+            for line in file:
+                word, count = line.rstrip("\n").rsplit("\t", 1)
+                vocab[word] = int(count)
+        self.vocab_counts = vocab
+        return vocab
+
+    def _count_corpus(self, sentences, normalise_digits, num_workers, chunk_size, write_corpus, write_mode):
+        """Count tokens of sentences, copying them to the corpus file in the same pass if write_corpus"""
+        corpus_file = None
+        if write_corpus:
+            corpus_file = open(os.path.join(self.datadir, self.corpus_file), write_mode)
+            sentences = _write_through(sentences, corpus_file)
+        try:
+            if num_workers > 1:
+                return self._count_tokens_parallel(sentences, normalise_digits, num_workers, chunk_size)
+            return _count_tokens(self.tokeniser, sentences, normalise_digits, report_every=5000)
+        finally:
+            if corpus_file is not None:
+                corpus_file.close()
+
+    def _set_counts(self, vocab):
+        """Keep and write the frequency table, and the vocabulary selected from it"""
+        self.vocab_counts = vocab
+        counts_path = os.path.join(self.datadir, self.counts_file)
+        print('Writing {} ...'.format(counts_path))
+        with open(counts_path, 'w') as file:
+            for word, count in vocab.items():
+                file.write("{}\t{}\n".format(word, count))
+
+        vocab_list = self._select_vocabulary(vocab)
         self.vocab_list = vocab_list
 
         # Write vocabulary to file
         vocab_path = os.path.join(self.datadir, self.vocab_file)
         self._write_file_from_list(vocab_path, vocab_list)
 
+    def _count_tokens_parallel(self, sentences, normalise_digits, num_workers, chunk_size):
+        """
+        Count tokens of sentence chunks in a process pool and merge the counts in chunk order,
+        so words keep their first-seen order and ties sort exactly as in a single process count.
+        At most 2 * num_workers chunks are in flight, so sentences are consumed as a stream.
+        The tokeniser is sent to each worker once, tasks only carry their chunk.
+        """
+        sentences = iter(sentences)
+        chunks = iter(lambda: list(islice(sentences, chunk_size)), [])
+        vocab = {}
+        n_merged = 0
+
+        def merge(result):
+            for word, count in result.get().items():
+                vocab[word] = vocab.get(word, 0) + count
+
+        with Pool(num_workers, initializer=_init_count_worker, initargs=(self._plain_tokeniser(),)) as pool:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(_count_chunk, (chunk, normalise_digits)))
+                if len(pending) >= 2 * num_workers:
+                    merge(pending.popleft())
+                    n_merged += 1
+                    print("  counted chunk {}".format(n_merged))
+            while pending:
+                merge(pending.popleft())
+        return vocab
+
+    def _select_vocabulary(self, vocab):
+        """
+        Start vocabulary followed by the most frequent words, up to max_vocabulary_size entries.
+        heapq.nlargest matches sorted(reverse=True) including tie order, without a full sort.
+        """
+        start_vocab = START_VOCAB_dict['with_padding']
+        n_words = max(self.max_vocabulary_size - len(start_vocab), 0)
+        vocab_list = start_vocab + heapq.nlargest(n_words, vocab, key=vocab.get)
+        return vocab_list[:self.max_vocabulary_size]
+
     def build_label_vocabulary(self, labels):
         labels = sorted(set(labels))
         self.label_list = labels
         label_path = os.path.join(self.datadir, self.label_file)
         self._write_file_from_list(label_path, labels)
 
+    def load_vocabulary(self):
+        """Load the vocabulary lists written to datadir by an earlier build"""
+        vocab_path = os.path.join(self.datadir, self.vocab_file)
+        label_path = os.path.join(self.datadir, self.label_file)
+        if os.path.isfile(vocab_path):
+            self.vocab_list = list(iter_lines(vocab_path))
+        if os.path.isfile(label_path):
+            self.label_list = list(iter_lines(label_path))
+
     def get_sentence_vocabulary(self):
+        if not self.vocab_list:
+            self.load_vocabulary()
         vocab, rev_vocab = self.initialise_vocabulary(self.vocab_list)
         self.vocab_to_id = vocab
         self.id_to_vocab = rev_vocab
+        self._encode_caches = {}
         return vocab, rev_vocab
 
     def get_label_vocabulary(self):
+        if not self.label_list:
+            self.load_vocabulary()
         vocab, rev_vocab = self.initialise_vocabulary(self.label_list)
         self.label_to_id = vocab
         self.id_to_label = rev_vocab
@@ -119,6 +388,12 @@ class Vocabulary(object):
             words.extend(re.split(_WORD_SPLIT, space_separated_fragment))
         return [w for w in words if w]
 
+    def _plain_tokeniser(self):
+        """self.tokeniser, with basic_tokeniser replaced by the equivalent _TOKEN_RE, which needs no self"""
+        if self.tokeniser == self.basic_tokeniser:
+            return _TOKEN_RE.findall
+        return self.tokeniser
+
     def sentence_to_token_ids(self, sentence, UNK_ID, normalise_digits=True):
         words = self.tokeniser(sentence)
         if not normalise_digits:
@@ -126,32 +401,94 @@ class Vocabulary(object):
         # Normalize digits by 0 before looking words up in the vocabulary.
         return [self.vocab_to_id.get(re.sub(_DIGIT_RE, "0", w), UNK_ID) for w in words]
 
+    def encode_sentences(self, sentences, use_padding=True, normalise_digits=True, as_array=False):
+        """
+        Convert a list or iterator of sentences to token IDs, as sentence_to_token_ids() does one by one.
+        Token IDs are memoised per raw token, normalising digits only for tokens that contain any.
+        Returns a list of token ID lists, or with as_array a flat int32 array of token IDs
+        and int64 offsets, sentence i being tokens[offsets[i]:offsets[i+1]].
+        """
+        UNK_ID = UNK_ID_dict['with_padding'] if use_padding else UNK_ID_dict['no_padding']
+        cache = self._encode_caches.setdefault((UNK_ID, normalise_digits), {})
+        encode_word = partial(self._encode_word, cache=cache, UNK_ID=UNK_ID, normalise_digits=normalise_digits)
+        tokenise = self._plain_tokeniser()
+
+        if as_array:
+            tokens  = array('i')
+            offsets = array('q', [0])
+            for sentence in sentences:
+                tokens.extend([cache[w] if w in cache else encode_word(w) for w in tokenise(sentence)])
+                offsets.append(len(tokens))
+            return np.frombuffer(tokens, dtype=np.int32), np.frombuffer(offsets, dtype=np.int64)
+
+        return [[cache[w] if w in cache else encode_word(w) for w in tokenise(sentence)]
+                for sentence in sentences]
+
+    def _encode_word(self, word, cache, UNK_ID, normalise_digits):
+        """Look up an uncached token and cache it, the cache is emptied once it is full."""
+        if len(cache) >= self.encode_cache_size:
+            cache.clear()
+        if normalise_digits and _DIGIT_RE.search(word):
+            token_id = self.vocab_to_id.get(re.sub(_DIGIT_RE, "0", word), UNK_ID)
+        else:
+            token_id = self.vocab_to_id.get(word, UNK_ID)
+        cache[word] = token_id
+        return token_id
+
     def data_to_token_ids(self, data, split_name, use_padding=True, normalise_digits=True):
         """
         Converts a list of data into its token IDs, writes
         them to a file, and returns the ID form of the data
         """
+        key = None
+        if self.cache is not None:
+            key = self._tokens_digest(data, use_padding, normalise_digits).hexdigest()
+            entry = self.cache.get(key)
+            if entry is not None:
+                print('Token IDs found in cache {}'.format(entry))
+                tokens, offsets, _ = self._load_binary(os.path.join(entry, self.ids_binary_file))
+                tokenised_data = [tokens[start:end].tolist() for start, end in zip(offsets[:-1], offsets[1:])]
+                self._write_token_files(data, tokenised_data, split_name, key)
+                return tokenised_data
+
         tokenised_data = []
-        for i, line in enumerate(data):
-            if i % 5000 == 0 and i != 0:
-                print('  tokenising line {}'.format(i))
-            if use_padding:
-                UNK_ID = UNK_ID_dict['with_padding']
-            else:
-                UNK_ID = UNK_ID_dict['no_padding']
-            token_ids = self.sentence_to_token_ids(line, UNK_ID, normalise_digits)
-            tokenised_data.append(token_ids)
+        with timed_stage(self.timer, 'tokenise') as stage:
+            stage.items = len(data)
+            for start in range(0, len(data), 5000):
+                if start != 0:
+                    print('  tokenising line {}'.format(start))
+                tokenised_data.extend(self.encode_sentences(data[start : start+5000], use_padding, normalise_digits))
 
-        # write file
+        if key is not None:
+            tmp_entry = self.cache.new_entry(key)
+            lengths = np.array([len(token_ids) for token_ids in tokenised_data], dtype=np.int64)
+            offsets = np.concatenate([[0], np.cumsum(lengths)])
+            tokens  = np.fromiter(chain.from_iterable(tokenised_data), dtype=np.int32, count=offsets[-1])
+            self._write_binary_split(os.path.join(tmp_entry, self.ids_binary_file),
+                                     tokens, offsets, np.zeros(len(lengths), dtype=np.int32), bytes(32))
+            self.cache.commit(key, tmp_entry)
+
+        self._write_token_files(data, tokenised_data, split_name, key)
+        return tokenised_data
+
+    def _write_token_files(self, data, tokenised_data, split_name, key=None):
+        """Write sentences and token IDs of a split, skipped if the split already holds the cache entry key"""
         write_dir = os.path.join(self.datadir, split_name)
         if not os.path.exists(write_dir):
             os.makedirs(write_dir)
         sents_file     = os.path.join(write_dir, self.sentences_file)
         ids_sents_file = os.path.join(write_dir, self.ids_sentences_file)
+        key_file       = os.path.join(write_dir, self.ids_key_file)
 
+        if key is not None and os.path.isfile(key_file) and os.path.isfile(ids_sents_file):
+            with open(key_file) as file:
+                if file.read().strip() == key:
+                    return
         self._write_file_from_list(sents_file, data)
         self._write_file_from_list(ids_sents_file, tokenised_data)
-        return tokenised_data
+        if key is not None:
+            with open(key_file, 'w') as file:
+                file.write(key + "\n")
 
     def labels_to_token_ids(self, labels, split_name):
         tokenised_labels = []
@@ -169,6 +506,101 @@ class Vocabulary(object):
         self._write_file_from_list(ids_labels_file, tokenised_labels)
         return tokenised_labels
 
+    def split_to_binary(self, sentences, labels, split_name, use_padding=True, normalise_digits=True):
+        """
+        Tokenise a split into the binary token ID file of split_name, see load_binary_split().
+        The file header keeps a hash of the sentences, labels, vocabularies and settings,
+        an unchanged split is not tokenised again.
+        """
+        digest = self._split_digest(sentences, labels, use_padding, normalise_digits)
+        binary_path = os.path.join(self.datadir, split_name, self.ids_binary_file)
+        if self._binary_is_current(binary_path, digest):
+            print('Token IDs of {} split are up to date'.format(split_name))
+        else:
+            with timed_stage(self.timer, 'tokenise') as stage:
+                tokens, offsets = self.encode_sentences(sentences, use_padding, normalise_digits, as_array=True)
+                stage.items = len(offsets) - 1
+            label_ids = np.array([self.label_to_id[label] for label in labels], dtype=np.int32)
+            self._write_binary_split(binary_path, tokens, offsets, label_ids, digest)
+        return self.load_binary_split(split_name)
+
+    def load_binary_split(self, split_name):
+        """
+        Memory-map the binary token ID file of split_name, without reading or copying it.
+        Returns (tokens, offsets, label_ids), sentence i being tokens[offsets[i]:offsets[i+1]],
+        which can be passed straight to batches.TokenCorpus.
+        """
+        binary_path = os.path.join(self.datadir, split_name, self.ids_binary_file)
+        return self._load_binary(binary_path)
+
+    def _load_binary(self, binary_path):
+        header = self._read_binary_header(binary_path)
+        n_examples, n_tokens = header['n_examples'], header['n_tokens']
+
+        offset = _IDS_HEADER.size
+        offsets = _memmap(binary_path, np.int64, offset, n_examples + 1)
+        offset += offsets.nbytes
+        tokens = _memmap(binary_path, np.int32, offset, n_tokens)
+        offset += tokens.nbytes
+        label_ids = _memmap(binary_path, np.int32, offset, n_examples)
+        return tokens, offsets, label_ids
+
+    def _tokeniser_name(self):
+        tokeniser = getattr(self.tokeniser, '__func__', self.tokeniser)
+        return '{}.{}'.format(tokeniser.__module__, tokeniser.__qualname__)
+
+    def _corpus_digest(self, normalise_digits):
+        """Hash of the vocabulary build settings, sentences are added to it by _hash_through()"""
+        digest = hashlib.sha256()
+        digest.update('vocabulary {} {} {}\n'.format(
+            self.max_vocabulary_size, normalise_digits, self._tokeniser_name()).encode())
+        return digest
+
+    def _tokens_digest(self, data, use_padding, normalise_digits):
+        digest = hashlib.sha256()
+        digest.update('tokens {} {} {}\n'.format(use_padding, normalise_digits, self._tokeniser_name()).encode())
+        digest.update('\n'.join(self.vocab_list).encode() + b'\0')
+        for _ in _hash_through(data, digest):
+            pass
+        return digest
+
+    def _split_digest(self, sentences, labels, use_padding, normalise_digits):
+        digest = hashlib.sha256()
+        digest.update('{} {} {}\n'.format(use_padding, normalise_digits, self._tokeniser_name()).encode())
+        for item_list in (self.vocab_list, self.label_list, labels, sentences):
+            digest.update('\n'.join(str(item) for item in item_list).encode())
+            digest.update(b'\0')
+        return digest.digest()
+
+    def _write_binary_split(self, binary_path, tokens, offsets, label_ids, digest):
+        write_dir = os.path.dirname(binary_path)
+        if not os.path.exists(write_dir):
+            os.makedirs(write_dir)
+        print('Writing {} ...'.format(binary_path))
+        # written next to the file and moved over it, so an interrupted write leaves no partial file
+        tmp_path = binary_path + '.tmp'
+        with open(tmp_path, 'wb') as file:
+            file.write(_IDS_HEADER.pack(_IDS_MAGIC, len(self.vocab_list), len(offsets) - 1, len(tokens), digest))
+            file.write(np.ascontiguousarray(offsets, dtype=np.int64).tobytes())
+            file.write(np.ascontiguousarray(tokens, dtype=np.int32).tobytes())
+            file.write(np.ascontiguousarray(label_ids, dtype=np.int32).tobytes())
+        os.replace(tmp_path, binary_path)
+
+    def _binary_is_current(self, binary_path, digest):
+        """True if the binary token ID file is complete and was written for digest"""
+        if not os.path.isfile(binary_path) or os.path.getsize(binary_path) < _IDS_HEADER.size:
+            return False
+        header = self._read_binary_header(binary_path)
+        n_examples, n_tokens = header['n_examples'], header['n_tokens']
+        expected_size = _IDS_HEADER.size + 8 * (n_examples + 1) + 4 * n_tokens + 4 * n_examples
+        return header['digest'] == digest and os.path.getsize(binary_path) == expected_size
+
+    def _read_binary_header(self, binary_path):
+        with open(binary_path, 'rb') as file:
+            magic, vocab_size, n_examples, n_tokens, digest = _IDS_HEADER.unpack(file.read(_IDS_HEADER.size))
+        assert magic == _IDS_MAGIC, "Not a token ID file: {}".format(binary_path)
+        return {'vocab_size': vocab_size, 'n_examples': n_examples, 'n_tokens': n_tokens, 'digest': digest}
+
     def translate_examples(self, examples):
         for sentence_tokens, label_token in examples:
             sentence_list = []
@@ -181,8 +613,12 @@ class Vocabulary(object):
 
     def _write_file_from_list(self, filename, write_list):
         print('Writing {} ...'.format(filename))
-        with open(filename,'w') as file:
-            for write_line in write_list:
-                if not isinstance(write_line, (str, int)):
-                    write_line = " ".join([str(item) for item in write_line])
-                file.write(str(write_line) + "\n")
+        with timed_stage(self.timer, 'file_write') as stage:
+            n_lines = 0
+            with open(filename,'w') as file:
+                for n_lines, write_line in enumerate(write_list, 1):
+                    if not isinstance(write_line, (str, int)):
+                        write_line = " ".join([str(item) for item in write_line])
+                    file.write(str(write_line) + "\n")
+            stage.items = n_lines
+            stage.n_bytes = os.path.getsize(filename)